@@ -41,9 +41,12 @@ Created on Tue Oct  4 21:11:08 2022
 @author: Rawwad Alhejaili (Python Code), M.D.Sacchi (Original MATLAB Code)
 """
 
+import math
+from functools import lru_cache
 import torch
 # import torch.nn as nn
 import torch.nn.functional as F
+from torch.autograd.function import once_differentiable
 
 # class my_custom_func(torch.autograd.Function):
 #     # Functions such as floor, ceil, and round have zero gradients everywhere
@@ -90,56 +93,170 @@ import torch.nn.functional as F
 #     def forward(self, x):
 #         return self.func.apply(x)
 
+@lru_cache(maxsize=None)
+def _triangle_kernel(L, dtype, device):
+    # Triangular window of 2L+1 samples, with shape (1,1,2L+1) for conv1d.
+    # Cached so that it is not rebuilt (and copied to the device) every call
+    h = 1-torch.linspace(-1, 1, 2*L+3).abs()[1:-1]
+    return h.reshape(1,1,-1).to(dtype=dtype, device=device)
+
+def _smooth(eT, L):
+    # Convolves every trace of eT (..., nx, nt) with the triangular window 
+    # (zero padding, 'same' size). The window is symmetric, so this is also
+    # its own adjoint (used by the backward pass of AGCFunction)
+    nt = eT.shape[-1]
+    h = _triangle_kernel(L, eT.dtype, eT.device)
+    return F.conv1d(eT.reshape(-1, 1, nt), h, padding=L).reshape(eT.shape)
+
+def _acc_dtype(d):
+    # float16 and bfloat16 are accumulated in float32
+    return d.dtype if d.dtype in [torch.float32, torch.float64] else torch.float32
+
+def _gate_length(dt, parameters):
+    return int(math.floor((parameters/dt+1)/2))
+
 def AGC(d, dt, parameters, option2, return_gain_map=False):
+    # d has the shape (..., nt, nx). The traces are reshaped into a batch of 
+    # (B*nx, 1, nt) signals and smoothed with conv1d. float16 and bfloat16
+    # inputs are accumulated in float32 (the output keeps the input dtype).
+    # When no gradients are needed, the temporaries are overwritten in place
+    # to limit the peak memory.
     nt = d.shape[-2]
-    device = d.device
+    acc = _acc_dtype(d)
+    inplace = not (torch.is_grad_enabled() and d.requires_grad)
+    L = _gate_length(dt, parameters)
     
-    # L = parameters/dt+1
-    # L = np.floor(L/2)
-    # h = torch.tensor(triang(2*L+1).reshape(1,1,-1,1), dtype=d.dtype).to(device)
+    dT = d.transpose(-1, -2)  #(..., nx, nt) view (each trace is contiguous below)
+    if inplace:
+        e = torch.empty(dT.shape, dtype=acc, device=d.device)
+        e.copy_(dT).square_()
+    else:
+        e = dT.to(acc).square()
+    conv_e_h = _smooth(e, L)
+    del e
+    if inplace:
+        rms = conv_e_h.sqrt_()
+        epsi = 1e-10*rms.max()
+        gain_map = rms.div_(rms.square().add_(epsi))
+    else:
+        rms = conv_e_h.sqrt()
+        epsi = 1e-10*rms.max()
+        gain_map = rms/(rms**2+epsi)
+    dout = dT * gain_map
     
-    L = torch.tensor(parameters/dt+1, dtype=d.dtype)
-    L = torch.floor(L/2).long()
-    h = (1-torch.linspace(-1, 1, 2*L+3).abs()[1:-1].reshape(1,1,-1,1)).type(d.dtype)
+    if option2==1:                #% Normalize by amplitude 
+        amax = torch.maximum(dout.amax(dim=-1, keepdim=True), 
+                             -dout.amin(dim=-1, keepdim=True))
+    elif option2==2:              # Normalize by rms 
+        amax = torch.linalg.vector_norm(dout, dim=-1, keepdim=True) / math.sqrt(nt)
+    if option2 in [1, 2]:
+        amax = torch.where(amax == 0, torch.ones_like(amax), amax)  #Avoid zero division
+        if inplace:
+            dout.div_(amax)
+            gain_map.div_(amax)
+        else:
+            dout = dout / amax
+            gain_map = gain_map / amax
     
-       
-    # for k in range(nx):
-    aux = d.clone()
-    e = aux**2
-    conv_e_h = F.conv2d(e, h.to(device), padding='same')
-    rms = torch.sqrt(conv_e_h)
-    epsi = 1e-10*rms.max()
-    # a,b = rms, rms**2+epsi
-    # non_zero_idx = b!=0
+    # Back to (..., nt, nx) (transposed views, no copy unless the dtype changes)
+    dout = dout.transpose(-1, -2).to(d.dtype)
+    if return_gain_map:
+        return dout, gain_map.transpose(-1, -2).to(d.dtype)
+    else:
+        return dout
+
+class AGCFunction(torch.autograd.Function):
+    # Same AGC as AGC(...), but autograd does not store any of its full size
+    # intermediates (e, conv_e_h, rms, ...). Only the input, the (normalized)
+    # gain map and the normalization factor of each trace (small) are saved,
+    # and the gradient is computed analytically in the backward pass. With
+    # 
+    #   r = sqrt(conv(d**2, h)),  g(r) = r/(r**2+epsi),  y = d*g(r)
+    #
+    # the gradient of y is
+    #
+    #   grad_d = grad_y*g(r) + d*conv(u, h),  u = grad_y*d*g'(r)/r
+    #
+    # where g'(r) = (epsi-r**2)/(r**2+epsi)**2 (and u = 0 where r = 0). h is
+    # symmetric, so it is its own adjoint. r is recomputed from the input
+    # (a single conv1d). Note that epsi (1e-10 times the largest rms) is 
+    # treated as a constant.
     
-    # op = a.clone()
-    # op = a / b
-    # op[non_zero_idx] = a[non_zero_idx] / b[non_zero_idx]
-    # op = np.divide(a, b, out=np.zeros_like(a), where=b!=0)
-    gain_map = rms/(rms**2+epsi)
-    dout = d * gain_map
-    # print(dout.shape)
-       
-    if option2==1:                #% Normalize by amplitude 
-        aux  = dout.clone().abs()
-        amax = aux.max(dim=-2, keepdims=True)[0]
-        zero_idx = amax==0
-        amax[zero_idx] += 1 #Avoid zero division
-        dout = dout / amax
-        gain_map = gain_map / amax
-       
-       
-    if option2==2:                # Normalize by rms 
-        aux  = torch.pow(dout, 2)
-        amax = aux.sum(dim=-2, keepdims=True)[0]
-        amax = torch.sqrt(amax/nt)
-        zero_idx = amax==0
-        amax[zero_idx] += 1 #Avoid zero division
-        # dout /= amax
-        # gain_map /= amax
-        dout = dout / amax
-        gain_map = gain_map / amax
+    @staticmethod
+    def forward(ctx, d, dt, parameters, option2):
+        nt = d.shape[-2]
+        acc = _acc_dtype(d)
+        L = _gate_length(dt, parameters)
+        
+        dT = d.transpose(-1, -2)
+        e = torch.empty(dT.shape, dtype=acc, device=d.device)
+        e.copy_(dT).square_()
+        rms = _smooth(e, L).sqrt_()
+        del e
+        epsi = 1e-10*rms.max()
+        gain_map = rms.div_(rms.square().add_(epsi))
+        dout = dT * gain_map
+        
+        idx = None
+        if option2==1:                #% Normalize by amplitude 
+            amax, idx = dout.abs().max(dim=-1, keepdim=True)
+        elif option2==2:              # Normalize by rms 
+            amax = torch.linalg.vector_norm(dout, dim=-1, keepdim=True) / math.sqrt(nt)
+        else:
+            amax = torch.ones(dout.shape[:-1] + (1,), dtype=acc, device=d.device)
+        amax = torch.where(amax == 0, torch.ones_like(amax), amax)  #Avoid zero division
+        dout.div_(amax)
+        gain_map.div_(amax)
+        
+        ctx.save_for_backward(d, gain_map, amax, idx)
+        ctx.L, ctx.epsi, ctx.option2 = L, epsi.item(), option2
+        dout = dout.transpose(-1, -2).to(d.dtype)
+        gain_out = gain_map.transpose(-1, -2).to(d.dtype)
+        ctx.mark_non_differentiable(gain_out)
+        return dout, gain_out
     
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_out, grad_gain):
+        d, gain_map, amax, idx = ctx.saved_tensors
+        L, epsi, option2 = ctx.L, ctx.epsi, ctx.option2
+        acc = gain_map.dtype
+        nt = d.shape[-2]
+        dT = d.transpose(-1, -2).to(acc)
+        grad = grad_out.transpose(-1, -2).to(acc)
+        
+        # Gradient of the normalization (out = y/amax)
+        if option2 in [1, 2]:
+            out = dT * gain_map
+            s = (grad*out).sum(dim=-1, keepdim=True)
+            if option2==1:
+                # amax = |y[idx]|, so only the sample at idx gets the extra term
+                sign = out.gather(-1, idx).sign()
+                grad = grad.scatter_add(-1, idx, -s*sign)
+            else:
+                grad = grad - out*(s/nt)
+            del out
+            grad.div_(amax)
+        
+        # Gradient of y = d*g(r)
+        gain = gain_map * amax  #g(r) before the normalization
+        rms = _smooth(dT.square(), L).sqrt_()
+        r2 = rms.square()
+        u = (epsi - r2).div_(r2.add_(epsi).square_())  #g'(r)
+        del r2
+        u = torch.where(rms > 0, u/rms, torch.zeros_like(u))
+        del rms
+        u.mul_(grad).mul_(dT)
+        grad_d = grad.mul_(gain).addcmul_(dT, _smooth(u, L))
+        return grad_d.transpose(-1, -2).to(d.dtype), None, None, None
+
+def AGC_autograd(d, dt, parameters, option2, return_gain_map=False):
+    '''
+    Same as AGC, but much lighter on memory when gradients are needed (e.g.
+    AGC weighted losses), see AGCFunction. The gain map is returned without
+    gradients.
+    '''
+    dout, gain_map = AGCFunction.apply(d, dt, parameters, option2)
     if return_gain_map:
         return dout, gain_map
     else:
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 19:45:12 2026
+
+A small LRU cache for AGC results. When the same reference image (e.g. the
+ground truth shot) is shown next to every new prediction with AGC=True and
+rang=<index>, imshow2 would otherwise recompute the exact same gain map on
+every call.
+
+The key of an image is made of the AGC parameters and:
+    - numpy arrays: a blake2b hash of the content (plus shape and dtype), so
+      an array that was modified in place is never mistaken for the old one.
+    - tensors: the data pointer, the version counter (bumped by every in
+      place operation), shape, stride, dtype and device. Hashing is avoided
+      since it would require a device to host copy. A weak reference to the
+      storage of the tensor is kept as well, so that a new tensor that was
+      allocated at the same address (after the old one was freed) is not
+      mistaken for the old one.
+
+Note: the cached results are shared between calls, so they should never be
+modified in place (numpy results are made read-only for that reason).
+
+@author: ruwwad
+"""
+
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+import numpy as np
+import torch
+from AGC_np import AGC_np
+from AGC import AGC
+
+def _key(Im):
+    # Returns (key, storage of the tensor or None)
+    if torch.is_tensor(Im):
+        key = ('tensor', Im.data_ptr(), Im._version, tuple(Im.shape),
+               Im.stride(), Im.dtype, Im.device)
+        return key, Im.untyped_storage()
+    Im = np.ascontiguousarray(Im)
+    digest = hashlib.blake2b(Im.view(np.uint8).reshape(-1), digest_size=16).digest()
+    return ('array', digest, Im.shape, Im.dtype.str), None
+
+class AGCCache:
+    '''
+    LRU cache of (dout, gain_map) pairs.
+
+    Example:
+        cache = AGCCache(maxsize=8)
+        dout, gain_map = cache(shot, 25/1000, 0.5, 1)
+    '''
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  #key: (storage weakref, dout, gain_map)
+        self._lock = threading.Lock()  #imshow2 may run in a thread pool
+
+    def __call__(self, Im, dt, parameters, option2):
+        '''
+        Returns (dout, gain_map) of the AGC of Im (AGC.AGC for tensors, on
+        their own device, and AGC_np for arrays). Computed only once for the
+        same image and parameters.
+        '''
+        key, storage = _key(Im)
+        key = key + (dt, parameters, option2)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (storage is None or entry[0]() is storage):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1], entry[2]
+            self.misses += 1
+        
+        if torch.is_tensor(Im):
+            with torch.no_grad():
+                dout, gain_map = AGC(Im, dt, parameters, option2, return_gain_map=True)
+        else:
+            dout, gain_map = AGC_np(np.asarray(Im), dt, parameters, option2,
+                                    return_gain_map=True)
+            dout.setflags(write=False)
+            gain_map.setflags(write=False)
+
+        with self._lock:
+            ref = None if storage is None else weakref.ref(storage)
+            self._entries[key] = (ref, dout, gain_map)
+            # Drop the tensors that no longer exist, then the least recently used
+            for k in [k for k, e in self._entries.items()
+                      if e[0] is not None and e[0]() is None]:
+                del self._entries[k]
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return dout, gain_map
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+# Shared by imshow2
+agc_cache = AGCCache()
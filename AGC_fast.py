@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 16:27:05 2026
+
+Same AGC as AGC_np.AGC_np (numpy arrays) and AGC.AGC (tensors), but the cost
+does NOT depend on the length of the AGC gate.
+
+Both of the original functions smooth the energy of the traces (d**2) with a
+triangular window of 2L+1 samples, which costs O(nt*L) per trace. However,
+the triangular window is just two box filters of L+1 samples in a row:
+
+    triang(2L+1) = conv(ones(L+1), ones(L+1)) / (L+1)
+
+and a box filter is the difference of a cumulative sum, so the whole
+smoothing costs two cumsums, O(nt) per trace, whatever the gate is.
+
+The cumulative sums are accumulated in float64 (the differences of large
+running sums lose precision otherwise), except on devices that do not
+support float64 (e.g. mps), where float32 is used instead. Use check_AGC_fast
+to compare the results against the original functions.
+
+@author: ruwwad
+"""
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from AGC_np import AGC_np
+from AGC import AGC
+
+def _box_np(x, m):
+    # Full convolution with ones(m) along axis -2: out[i] = sum(x[i-m+1:i+1])
+    pad = [(0, 0)]*x.ndim
+    pad[-2] = (m, m-1)
+    c = np.cumsum(np.pad(x, pad), axis=-2)
+    return c[..., m:, :] - c[..., :-m, :]
+
+def _box_torch(x, m):
+    c = torch.cumsum(F.pad(x, (0, 0, m, m-1)), dim=-2)
+    return c[..., m:, :] - c[..., :-m, :]
+
+def triangle_smooth(e, L):
+    '''
+    Same as convolving every trace of e (along axis -2) with triang(2L+1)
+    with zero padding and 'same' output size, in O(nt) per trace.
+
+    Parameters
+    ----------
+    e : TYPE = numpy array or tensor with shape (..., nt, nx)
+        The traces (e.g. their energy).
+    L : TYPE = int
+        Half length of the triangular window.
+
+    Returns
+    -------
+    The smoothed traces (float64, or float32 on devices without float64).
+    '''
+    m = int(L) + 1
+    nt = e.shape[-2]
+    if torch.is_tensor(e):
+        acc = torch.float32 if e.device.type == 'mps' else torch.float64
+        s = _box_torch(_box_torch(e.to(acc), m), m)[..., L:L+nt, :] / m
+        return s.clamp(min=0)  #Rounding may leave tiny negative energies
+    s = _box_np(_box_np(np.asarray(e, dtype=np.float64), m), m)[..., L:L+nt, :] / m
+    return np.maximum(s, 0, out=s)
+
+def _gate_length(dt, parameters):
+    return int(np.floor((parameters/dt+1)/2))
+
+def _AGC_fast_np(d, dt, parameters, option2, return_gain_map):
+    nt = d.shape[-2]
+    rms = np.sqrt(triangle_smooth(d**2, _gate_length(dt, parameters)))
+    epsi = 1e-10*rms.max(axis=-2, keepdims=True)  #One epsi per trace
+    a,b = rms, rms**2+epsi
+    op = np.divide(a, b, out=np.zeros_like(a), where=b!=0)
+    dout = (d*op).astype(d.dtype, copy=False)
+    gain_map = op.astype(d.dtype, copy=False)
+
+    if option2==1:                #% Normalize by amplitude
+        amax = np.max(np.abs(dout), axis=-2, keepdims=True)
+    elif option2==2:              # Normalize by rms
+        amax = np.sqrt(np.sum(dout**2, axis=-2, keepdims=True)/nt)
+    if option2 in [1, 2]:
+        amax[amax == 0] = 1  #Avoid zero division
+        dout = dout/amax
+        gain_map = gain_map/amax
+
+    if return_gain_map:
+        return dout, gain_map
+    else:
+        return dout
+
+def _AGC_fast_torch(d, dt, parameters, option2, return_gain_map):
+    nt = d.shape[-2]
+    rms = torch.sqrt(triangle_smooth(d**2, _gate_length(dt, parameters))).to(d.dtype)
+    epsi = 1e-10*rms.max()  #Same (global) epsi as AGC.AGC
+    gain_map = rms/(rms**2+epsi)
+    dout = d * gain_map
+
+    if option2==1:                #% Normalize by amplitude
+        amax = dout.abs().amax(dim=-2, keepdim=True)
+    elif option2==2:              # Normalize by rms
+        amax = torch.sqrt(dout.pow(2).sum(dim=-2, keepdim=True)/nt)
+    if option2 in [1, 2]:
+        amax = torch.where(amax == 0, torch.ones_like(amax), amax)  #Avoid zero division
+        dout = dout / amax
+        gain_map = gain_map / amax
+
+    if return_gain_map:
+        return dout, gain_map
+    else:
+        return dout
+
+def AGC_fast(d, dt, parameters, option2, return_gain_map=False):
+    '''
+    Parameters
+    ----------
+    d : TYPE = numpy array or tensor with shape (..., nt, nx)
+        The traces. Numpy arrays follow AGC_np.AGC_np (one epsi per trace),
+        and tensors follow AGC.AGC (one epsi for the whole tensor, and they
+        stay on their own device).
+    dt : TYPE = float
+        Sampling interval (in seconds).
+    parameters : TYPE = float
+        Length of the AGC gate (in seconds).
+    option2 : TYPE = int
+        0: No normalization.
+        1: Normalize each trace by its amplitude.
+        2: Normalize each trace by its rms value.
+    return_gain_map : TYPE = bool, optional
+        If True, the gain map is returned as well. The default is False.
+
+    Returns
+    -------
+    dout (and gain_map if return_gain_map=True)
+    '''
+    if torch.is_tensor(d):
+        return _AGC_fast_torch(d, dt, parameters, option2, return_gain_map)
+    return _AGC_fast_np(np.asarray(d), dt, parameters, option2, return_gain_map)
+
+def check_AGC_fast(d, dt=0.004, parameters=0.5, option2=1, rtol=1e-4):
+    '''
+    Compares AGC_fast against the original function (AGC_np.AGC_np for numpy
+    arrays with shape (nt,nx), AGC.AGC for tensors with shape (N,C,nt,nx)).
+
+    Returns
+    -------
+    (ok, err), where err is the largest absolute difference of both the
+    output and the gain map, relative to the largest absolute value of the
+    original, and ok = err <= rtol.
+    '''
+    if torch.is_tensor(d):
+        with torch.no_grad():
+            ref  = AGC(d, dt, parameters, option2, return_gain_map=True)
+            fast = AGC_fast(d, dt, parameters, option2, return_gain_map=True)
+        ref  = [x.double().cpu().numpy() for x in ref]
+        fast = [x.double().cpu().numpy() for x in fast]
+    else:
+        ref  = AGC_np(d, dt, parameters, option2, return_gain_map=True)
+        fast = AGC_fast(d, dt, parameters, option2, return_gain_map=True)
+    err = 0.
+    for r, f in zip(ref, fast):
+        scale = np.abs(r).max() or 1
+        err = max(err, float(np.abs(np.asarray(f, float) - r).max() / scale))
+    return err <= rtol, err
@@ -41,49 +41,171 @@ Created on Tue Oct  4 21:11:08 2022
 @author: Ruwwad Alhejaili (Python), M.D.Sacchi (MATLAB Code)
 """
 
+import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from scipy.signal import triang
-from scipy.signal import convolve2d as conv2
+from scipy.signal.windows import triang  #(scipy.signal.triang was removed in scipy 1.13)
+from scipy.ndimage import convolve1d
 
 def AGC_np(d, dt, parameters, option2, return_gain_map=False):
-    nt,nx= d.shape[-2], d.shape[-1]
+    # All traces are filtered at once along the time axis (no loop over the
+    # traces). convolve1d zero pads the ends just like conv2(...,'same') did,
+    # and the sums are accumulated in float64 like before.
+    # d can also be a stack of gathers with shape (..., nt, nx).
+    nt = d.shape[-2]
    
     dout = np.zeros(d.shape, dtype= d.dtype)
     gain_map = np.zeros(d.shape, dtype= d.dtype)
     L = parameters/dt+1
     L = np.floor(L/2)
-    h = triang(2*L+1).reshape(-1,1)
+    h = triang(2*L+1)
        
-    for k in range(nx):
-        aux =  d[:,k:k+1]
-        e = aux**2
-        rms = np.sqrt(conv2(e,h,'same'))  #why use 2D conv to a 1D signal?
-        epsi = 1e-10*rms.max()
-        a,b = rms, rms**2+epsi
-        op = np.divide(a, b, out=np.zeros_like(a), where=b!=0)
-        # op = rms/(rms**2+epsi)
-        dout[:,k:k+1] = d[:,k:k+1]*op
-        gain_map[:,k:k+1] = op
+    e = d**2
+    rms = np.sqrt(convolve1d(e, h, axis=-2, output=np.float64, mode='constant'))
+    epsi = 1e-10*rms.max(axis=-2, keepdims=True)  #One epsi per trace
+    a,b = rms, rms**2+epsi
+    op = np.divide(a, b, out=np.zeros_like(a), where=b!=0)
+    # op = rms/(rms**2+epsi)
+    dout[:] = d*op
+    gain_map[:] = op
     # print(dout.shape)
        
     if option2==1:                #% Normalize by amplitude 
-        for k in range(nx):
-            aux  = dout[:,k:k+1]
-            amax = np.max(np.abs(aux))
-            amax = amax or 1  #Avoid zero division
-            dout[:,k] = dout[:,k]/amax
-            gain_map[:,k] = gain_map[:,k]/amax
+        amax = np.max(np.abs(dout), axis=-2, keepdims=True)
+        amax[amax == 0] = 1  #Avoid zero division
+        dout[:] = dout/amax
+        gain_map[:] = gain_map/amax
        
        
     if option2==2:                # Normalize by rms 
-        for k in range(nx):
-            aux  = dout[:,k]
-            amax = np.sqrt(np.sum(aux**2)/nt)
-            amax = amax or 1  #Avoid zero division
-            dout[:,k] = dout[:,k]/amax
-            gain_map[:,k] = gain_map[:,k]/amax
+        amax = np.sqrt(np.sum(dout**2, axis=-2, keepdims=True)/nt)
+        amax[amax == 0] = 1  #Avoid zero division
+        dout[:] = dout/amax
+        gain_map[:] = gain_map/amax
         
     if return_gain_map:
         return dout, gain_map
     else:
         return dout
+
+def AGC_np_batch(D, dt, parameters, option2, return_gain_map=False,
+                 workers=None, chunk=1, out=None, gain_out=None):
+    '''
+    AGC of a whole stack of shot gathers (e.g. a full shot line), split into
+    chunks of shots that are processed in parallel on a thread pool. The heavy
+    lifting is done by numpy and scipy kernels that release the GIL, so the
+    threads actually run on separate cores (no pickling or copying to other
+    processes). Only the chunks that are being processed are loaded into
+    memory, so D can be a memmap that does not fit in memory (as long as out 
+    is a memmap as well).
+
+    Parameters
+    ----------
+    D : TYPE = numpy array or memmap with shape (N, C, nt, nx)
+        The shot gathers (any shape (N, ..., nt, nx) works).
+    dt, parameters, option2, return_gain_map :
+        Same as AGC_np.
+    workers : TYPE = int, optional
+        Number of threads. The default is None (os.cpu_count()).
+    chunk : TYPE = int, optional
+        Number of shots processed by a thread at a time. The default is 1.
+    out, gain_out : TYPE = numpy array or memmap with the shape of D, optional
+        Where the output (and the gain map) are written. The default is None
+        (new arrays with the dtype of D).
+
+    Returns
+    -------
+    out (and gain_out if return_gain_map=True)
+    '''
+    N = D.shape[0]
+    if out is None:
+        out = np.empty(D.shape, dtype=D.dtype)
+    if return_gain_map and gain_out is None:
+        gain_out = np.empty(D.shape, dtype=D.dtype)
+    workers = workers or os.cpu_count() or 1
+    chunk = max(int(chunk), 1)
+    
+    def job(start):
+        d = np.asarray(D[start:start+chunk])  #Loads the chunk (if D is a memmap)
+        if return_gain_map:
+            out[start:start+chunk], gain_out[start:start+chunk] = \
+                AGC_np(d, dt, parameters, option2, return_gain_map=True)
+        else:
+            out[start:start+chunk] = AGC_np(d, dt, parameters, option2)
+    
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # list() re-raises the errors of the threads (if any)
+        list(pool.map(job, range(0, N, chunk)))
+    
+    if return_gain_map:
+        return out, gain_out
+    else:
+        return out
+
+def AGC_np_file(src, dst, dt, parameters, option2, gain_dst=None,
+                chunk=None, max_bytes=2**27):
+    '''
+    Out-of-core AGC: the traces are read from src in chunks (along the trace
+    axis), and the results are written to dst, so the memory used does not
+    depend on the size of the file. Since the AGC of each trace only depends
+    on that trace, the output is the same as AGC_np of the whole panel (up 
+    to rounding in the rms normalization, option2=2).
+
+    Parameters
+    ----------
+    src : TYPE = str/path of a .npy file, or numpy array/memmap
+        The traces with shape (..., nt, nx). Files are opened with
+        mmap_mode='r' (never loaded as a whole).
+    dst : TYPE = str/path, or numpy array/memmap
+        Where the output is written. A path creates a new .npy file (through
+        np.lib.format.open_memmap) with the shape and dtype of src.
+    dt, parameters, option2 :
+        Same as AGC_np.
+    gain_dst : TYPE = str/path, or numpy array/memmap, optional
+        Where the gain map is written (same as dst). The default is None (the
+        gain map is not kept).
+    chunk : TYPE = int, optional
+        Number of traces processed at a time. The default is None (as many 
+        as fit in max_bytes).
+    max_bytes : TYPE = int, optional
+        Rough memory budget of a chunk (including the temporaries of AGC_np).
+        The default is 2**27 (128 MB).
+
+    Returns
+    -------
+    dst (and gain_dst if given), opened as memmaps if they were paths.
+    '''
+    if not isinstance(src, np.ndarray):
+        src = np.load(src, mmap_mode='r')
+    
+    def open_out(out):
+        if out is None or isinstance(out, np.ndarray):
+            return out
+        return np.lib.format.open_memmap(out, mode='w+', dtype=src.dtype, 
+                                         shape=src.shape)
+    dst = open_out(dst)
+    gain_dst = open_out(gain_dst)
+    
+    nt, nx = src.shape[-2], src.shape[-1]
+    if chunk is None:
+        # About 8 float64 buffers of the size of the chunk are alive at a time
+        chunk = max_bytes // (8 * 8 * nt)
+    chunk = int(min(max(chunk, 1), nx))
+    
+    for idx in np.ndindex(src.shape[:-2]):
+        for k in range(0, nx, chunk):
+            traces = idx + (slice(None), slice(k, k+chunk))
+            d = np.asarray(src[traces])
+            if gain_dst is None:
+                dst[traces] = AGC_np(d, dt, parameters, option2)
+            else:
+                dst[traces], gain_dst[traces] = \
+                    AGC_np(d, dt, parameters, option2, return_gain_map=True)
+    
+    for out in [dst, gain_dst]:
+        if isinstance(out, np.memmap):
+            out.flush()
+    if gain_dst is None:
+        return dst
+    else:
+        return dst, gain_dst
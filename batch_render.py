@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 12:03:51 2026
+
+Renders QC figures of a whole dataset (e.g. every shot gather of a file) to
+image files across a pool of processes. Each job is handed to a worker that
+draws it with the render function (no pyplot, see render.py) using the
+defaults stored in a lazy_imshow preset, and writes it to disk.
+
+- The preset is sent to each worker ONCE (when the worker starts), not with
+  every job.
+- At most max_in_flight jobs are submitted at any time, so a lazy iterable of
+  jobs (e.g. a generator that loads one shot at a time) is never loaded into
+  memory all at once.
+- Results are yielded in the order of the jobs (ordered=True) or as soon as
+  they are done (ordered=False).
+- A job that fails does not stop the others. Its error (traceback) is
+  reported in the result instead.
+- Large arrays are NOT pickled (share=True). Arrays that are backed by a
+  file (np.memmap, or np.load(..., mmap_mode='r')) are reopened by the worker
+  from the same file, and other arrays (including CPU tensors) are placed in
+  multiprocessing.shared_memory. Only small descriptors are sent to the
+  workers, which then read the data without copying it.
+
+Example:
+    from lazy_imshow import lazy_imshow
+    from batch_render import render_batch
+
+    shots = np.load('Images/Mobil_AVO_Viking_Graben_Line_12.npy', mmap_mode='r')
+    preset = lazy_imshow(aspect=1/3, clip=1, colorbar=True)
+    jobs = ({'I': shots[i], 'title': f'Shot {i}'} for i in range(len(shots)))
+    for result in render_batch(jobs, preset, out_dir='QC'):
+        if result.error:
+            print(f'Shot {result.index} failed:\n{result.error}')
+
+@author: ruwwad
+"""
+
+import os
+import sys
+import mmap
+import traceback
+from collections import namedtuple, deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+import torch
+from render import render
+try:
+    from numpy.lib.array_utils import byte_bounds
+except ImportError:  #numpy < 2
+    from numpy import byte_bounds
+
+# index: position of the job in the iterable
+# path:  the written file (None if the job failed)
+# error: traceback of the failure (None if the job succeeded)
+RenderResult = namedtuple('RenderResult', ['index', 'path', 'error'])
+
+# Descriptors that replace the arrays of a job when share=True
+SharedRef = namedtuple('SharedRef', ['name', 'shape', 'dtype'])
+MemmapRef = namedtuple('MemmapRef', ['filename', 'offset', 'nbytes', 
+                                     'start', 'shape', 'dtype', 'strides'])
+
+_preset = None  #The lazy_imshow preset of the current worker process
+
+def _memmap_ref(a):
+    # Returns a MemmapRef if the array is a view of a file mapped by np.memmap
+    root = a
+    while isinstance(root, np.ndarray):
+        if isinstance(root, np.memmap) and isinstance(root.base, mmap.mmap):
+            break
+        root = root.base
+    else:
+        return None
+    if root.filename is None:
+        return None
+    # The data of root starts at root.offset in the file
+    root_addr = root.__array_interface__['data'][0]
+    addr = a.__array_interface__['data'][0]
+    low, high = byte_bounds(a)
+    return MemmapRef(root.filename, root.offset + low - root_addr, high - low,
+                     addr - low, a.shape, a.dtype.str, a.strides)
+
+def share_arrays(obj, handles, min_bytes=2**16):
+    '''
+    Replaces the arrays (and CPU tensors) found in obj (an array, or a list,
+    tuple or dict that contains arrays) by descriptors that can be sent to
+    another process without pickling the data (see restore_arrays). The 
+    created SharedMemory blocks are appended to handles, and should be
+    released (close and unlink) by the caller once the job is done. Arrays
+    smaller than min_bytes are left as they are.
+    '''
+    if isinstance(obj, dict):
+        return {key: share_arrays(value, handles, min_bytes) 
+                for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(share_arrays(value, handles, min_bytes) 
+                         for value in obj)
+    if torch.is_tensor(obj) and obj.device.type == 'cpu':
+        obj = obj.detach().numpy()
+    if not isinstance(obj, np.ndarray) or obj.dtype.hasobject \
+            or obj.nbytes < min_bytes:
+        return obj
+    ref = _memmap_ref(obj)
+    if ref is not None:
+        return ref
+    shm = SharedMemory(create=True, size=obj.nbytes)
+    handles.append(shm)
+    np.ndarray(obj.shape, obj.dtype, buffer=shm.buf)[...] = obj
+    return SharedRef(shm.name, obj.shape, obj.dtype.str)
+
+def _attach(name):
+    # Attaching to an existing block must not register it with the resource 
+    # tracker, otherwise the block is unlinked when the worker exits
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name, track=False)
+    register = resource_tracker.register
+    resource_tracker.register = lambda *args, **kwargs: None
+    try:
+        return SharedMemory(name)
+    finally:
+        resource_tracker.register = register
+
+def restore_arrays(obj, handles):
+    '''
+    Reverses share_arrays (no data is copied). The attached SharedMemory 
+    blocks are appended to handles, and should be closed once the arrays are
+    no longer used (closing unmaps the memory, so the arrays must not be
+    accessed afterwards).
+    '''
+    if isinstance(obj, SharedRef):
+        shm = _attach(obj.name)
+        handles.append(shm)
+        return np.ndarray(obj.shape, np.dtype(obj.dtype), buffer=shm.buf)
+    if isinstance(obj, MemmapRef):
+        mm = np.memmap(obj.filename, np.uint8, mode='r', offset=obj.offset,
+                       shape=(obj.nbytes,))
+        return np.ndarray(obj.shape, np.dtype(obj.dtype), buffer=mm,
+                          offset=obj.start, strides=obj.strides)
+    if isinstance(obj, dict):
+        return {key: restore_arrays(value, handles) 
+                for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(restore_arrays(value, handles) for value in obj)
+    return obj
+
+def _release(handles, unlink=False):
+    for shm in handles:
+        try:
+            shm.close()
+            if unlink:
+                shm.unlink()
+        except (BufferError, FileNotFoundError):
+            pass
+
+def _init_worker(preset):
+    global _preset
+    _preset = preset
+
+def _render_job(index, job, path, format, kwargs):
+    handles = []
+    try:
+        job = restore_arrays(job, handles)
+        if isinstance(job, dict):
+            job = dict(job)
+            I = job.pop('I')
+            kwargs = {**kwargs, **job}
+        else:
+            I = job
+        if _preset is None:
+            buffer = render(I, format=format, **kwargs)
+        else:
+            buffer = _preset.render(I, format=format, **kwargs)
+        with open(path, 'wb') as f:
+            f.write(buffer)
+        return RenderResult(index, path, None)
+    except Exception:
+        return RenderResult(index, None, traceback.format_exc())
+    finally:
+        I = job = kwargs = None  #Drop the views before closing the shared memory
+        _release(handles)
+
+def render_batch(jobs,
+                 preset        = None,
+                 out_dir       = '.',
+                 filename      = '{index:05d}.{format}',
+                 format        = 'png',
+                 workers       = None,
+                 max_in_flight = None,
+                 ordered       = True,
+                 mp_context    = None,
+                 share         = True,
+                 **kwargs):
+    '''
+    Parameters
+    ----------
+    jobs : TYPE = iterable
+        Each job is either the images to be shown (the I argument of imshow2),
+        or a dictionary of arguments for imshow2 that includes 'I' (e.g.
+        {'I': shot, 'title': 'Shot 1'}).
+    preset : TYPE = lazy_imshow, optional
+        Its defaults are used for every job. The default is None (the
+        defaults of imshow2 are used instead).
+    out_dir : TYPE = str or path, optional
+        Where the files are written (created if it does not exist).
+        The default is '.'.
+    filename : TYPE = str, optional
+        Name of each file, formatted with the index of the job and the
+        format. The default is '{index:05d}.{format}'.
+    format : TYPE = str, optional
+        File format (passed to savefig). The default is 'png'.
+    workers : TYPE = int, optional
+        Number of processes. The default is None (os.cpu_count()).
+    max_in_flight : TYPE = int, optional
+        Maximum number of jobs that are submitted but not yet collected.
+        The default is None (2*workers).
+    ordered : TYPE = bool, optional
+        If True, the results are yielded in the order of the jobs. Otherwise,
+        they are yielded as soon as they are done. The default is True.
+    mp_context : TYPE = multiprocessing context, optional
+        Passed to ProcessPoolExecutor (e.g. multiprocessing.get_context('spawn')
+        when CUDA was initialized in the parent process). The default is None.
+    share : TYPE = bool, optional
+        If True, large arrays are sent to the workers through shared memory
+        (or by reopening their np.memmap file) instead of being pickled.
+        The default is True.
+    **kwargs :
+        Arguments passed to every job (overridden by the arguments of the job).
+
+    Yields
+    ------
+    RenderResult(index, path, error) for every job.
+    '''
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max(max_in_flight or 2*workers, 1)
+    os.makedirs(out_dir, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context,
+                             initializer=_init_worker,
+                             initargs=(preset,)) as pool:
+        pending = deque() if ordered else set()
+        handles = {}  #Shared memory of each submitted job
+        jobs = enumerate(jobs)
+        exhausted = False
+        try:
+            while True:
+                # Keep the pool busy without submitting more than max_in_flight
+                while not exhausted and len(pending) < max_in_flight:
+                    try:
+                        index, job = next(jobs)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    path = os.path.join(out_dir,
+                                        filename.format(index=index, format=format))
+                    job_handles = []
+                    if share:
+                        job = share_arrays(job, job_handles)
+                    future = pool.submit(_render_job, index, job, path, format, kwargs)
+                    handles[future] = job_handles
+                    if ordered:
+                        pending.append(future)
+                    else:
+                        pending.add(future)
+                if not pending:
+                    return
+                if ordered:
+                    done = [pending.popleft()]
+                    wait(done)
+                else:
+                    done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+                    pending -= done
+                for future in done:
+                    # The worker is done with the job, so its memory is freed
+                    _release(handles.pop(future), unlink=True)
+                    yield future.result()
+        finally:
+            # Only reached with pending jobs if the caller stopped early
+            for future in handles:
+                future.cancel()
+            wait(list(handles))
+            for job_handles in handles.values():
+                _release(job_handles, unlink=True)
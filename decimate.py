@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 19:02:44 2026
+
+Matplotlib resamples every image to the size of its axes at draw time, so
+handing it a 1500x120 shot gather (or a padded FFT that is 9 times larger)
+only to squeeze it into a few hundred pixels is a waste of both time and
+memory. The functions below compute how many pixels an axes can actually
+show, and reduce the image to that size BEFORE it reaches ax.imshow.
+
+Two pooling methods are available:
+    - 'minmax': keeps, for every block, whichever of its minimum or maximum
+      lies farther from the block mean. Thin seismic events (a single sample
+      spike for example) survive the reduction instead of being averaged out.
+    - 'mean': plain average pooling (smoother, better for RGB images).
+
+Tensors are reduced on their own device, so that only the reduced image has
+to be moved to the host.
+
+@author: ruwwad
+"""
+
+import numpy as np
+import torch
+
+def pixel_budget(dpi, plotsize, grid):
+    '''
+    Returns the number of (rows, columns) of pixels available to a single
+    axes of a figure created with figsize=(plotsize[0]*grid[1],
+    plotsize[1]*grid[0]) and the given dpi.
+    '''
+    fig_w = plotsize[0]*grid[1]*dpi
+    fig_h = plotsize[1]*grid[0]*dpi
+    return int(np.ceil(fig_h/grid[0])), int(np.ceil(fig_w/grid[1]))
+
+def decimate_image(Im, budget, method='minmax'):
+    '''
+    Parameters
+    ----------
+    Im : TYPE = numpy array or tensor with shape (H,W) or (H,W,C)
+        The image to be reduced.
+    budget : TYPE = tuple of ints with shape=(2,)
+        Maximum number of (rows, columns) to be kept (see pixel_budget).
+    method : TYPE = str, optional
+        Either 'minmax' or 'mean'. The default is 'minmax'.
+
+    Returns
+    -------
+    The reduced image. If the image already fits the budget, then it is
+    returned as is (no copy).
+    '''
+    H, W = Im.shape[0], Im.shape[1]
+    fh = int(np.ceil(H / max(budget[0], 1)))
+    fw = int(np.ceil(W / max(budget[1], 1)))
+    if fh <= 1 and fw <= 1:
+        return Im
+
+    # Replicate the edges so that both axes are divisible by their factors
+    pad_h = -H % fh
+    pad_w = -W % fw
+    if torch.is_tensor(Im):
+        if not Im.is_floating_point():
+            Im = Im.float()
+        if pad_h:
+            Im = Im[torch.arange(H+pad_h, device=Im.device).clamp(max=H-1)]
+        if pad_w:
+            Im = Im[:, torch.arange(W+pad_w, device=Im.device).clamp(max=W-1)]
+        amin, amax, where = torch.amin, torch.amax, torch.where
+    else:
+        if pad_h or pad_w:
+            pad = [(0, pad_h), (0, pad_w)] + [(0, 0)]*(Im.ndim-2)
+            Im = np.pad(Im, pad, mode='edge')
+        amin, amax, where = np.amin, np.amax, np.where
+
+    # (H,W,...) -> (H/fh, fh, W/fw, fw, ...)
+    blocks = Im.reshape((Im.shape[0]//fh, fh, Im.shape[1]//fw, fw) + tuple(Im.shape[2:]))
+    if method == 'mean':
+        return blocks.mean((1,3))
+    elif method == 'minmax':
+        lo   = amin(blocks, (1,3))
+        hi   = amax(blocks, (1,3))
+        mean = blocks.mean((1,3))
+        return where(hi - mean >= mean - lo, hi, lo)
+    else:
+        raise ValueError(f"Unknown decimation method '{method}'. "
+                         "Use either 'minmax' or 'mean'.")
@@ -14,7 +14,8 @@ most of the capabilities provided here.
 - Automatically applies cmap='seismic_r' to one channel images (configurable)
 - Removes the axes from the image
 - Works with tensors (by moving them to the cpu and detaching the gradients)
-- Works with 4D arrays (it uses the first sample for convenience)
+- Works with 4D arrays (it uses the first sample for convenience, which is
+  sliced before the array is converted or moved to the CPU)
 - Automatically moves the channel axis position to the last axis
 - Sets the DPI to 300 by default (configurable)
 - Adds a colorbar to the right (can be toggled on or off from the arguments)
@@ -66,19 +67,138 @@ import matplotlib.pyplot as plt
 # from matplotlib import ticker
 from mpl_toolkits.axes_grid1 import ImageGrid
 import warnings
+from contextlib import nullcontext
 import torch.fft as fft
-from scipy.fft import fft2, fftshift
+from scipy.fft import rfft2, next_fast_len
 try:
     from AGC_np import AGC_np  # optional: can perform auto gain correction
+    from AGC import AGC as AGC_tor  # same, but on the device of a tensor
+    from AGC_cache import agc_cache  # reuses the gain map of the same image
     AGC_import = True
 except ImportError:
     AGC_import = False
+from decimate import pixel_budget, decimate_image
+from imstats import imstats
 tr = torch
 # fft2tor = lambda x, k: 20*torch.log10(torch.finfo(x.dtype).eps+torch.abs(fft.fftshift(fft.fft2(x, (x.shape[-2]*k, x.shape[-1]*k)), (-2,-1)))).cpu().detach()
-fft2tor = lambda x, k: tr.finfo(x.dtype).eps+tr.abs(fft.fftshift(fft.fft2(x, (x.shape[-2]*k, x.shape[-1]*k)), (-2,-1))).cpu().detach()
-fft2np  = lambda x, k: np.finfo(x.dtype).eps+np.abs(    fftshift(    fft2(x, (x.shape[-2]*k, x.shape[-1]*k)), (-2,-1)))
+# fft2tor = lambda x, k: tr.finfo(x.dtype).eps+tr.abs(fft.fftshift(fft.fft2(x, (x.shape[-2]*k, x.shape[-1]*k)), (-2,-1))).cpu().detach()
+# fft2np  = lambda x, k: np.finfo(x.dtype).eps+np.abs(    fftshift(    fft2(x, (x.shape[-2]*k, x.shape[-1]*k)), (-2,-1)))
 decibal = lambda x: 20*np.log10(x)
 
+def _fft_size(x, k):
+    # Padded size of the spectrum (fft_factor times the image, rounded up to
+    # a size that the FFT handles quickly)
+    return (next_fast_len(x.shape[-2]*k), next_fast_len(x.shape[-1]*k, real=True))
+
+def _mirror(A, M, N):
+    '''
+    Returns the full, fftshifted (M,N) amplitude spectrum of a real image from
+    the amplitude A of its rfft2 (M, N//2+1), using |X[-f,-k]| = |X[f,k]|.
+    The columns are written straight to their shifted position. Works for 
+    both numpy arrays and tensors (with any leading batch dimensions).
+    '''
+    if torch.is_tensor(A):
+        rows = torch.arange(M, device=A.device)
+        out = torch.empty(A.shape[:-1] + (N,), dtype=A.dtype, device=A.device)
+        flip = lambda x: torch.flip(x, (-1,))
+    else:
+        rows = np.arange(M)
+        out = np.empty(A.shape[:-1] + (N,), dtype=A.dtype)
+        flip = lambda x: x[..., ::-1]
+    shift = (rows - M//2) % M        #Zero frequency to the center row
+    neg = shift[(2*(M//2) - rows) % M]  #Row of -f for every (shifted) row f
+    # Wavenumbers k = 0, ..., N//2 go to the columns N//2, N//2+1, ...
+    out[..., N//2:] = A[..., shift, :N-N//2]
+    if N % 2 == 0:  #The Nyquist wavenumber goes to the first column
+        out[..., 0] = A[..., shift, N//2]
+    # Negative wavenumbers k = N//2+1, ..., N-1 (from |X[-f,N-k]|)
+    out[..., 1-N%2:N//2] = flip(A[..., neg, 1:N-N//2])
+    return out
+
+def fft2tor(x, k):
+    # Real input FFT (half the work and memory of fft2). The spectrum stays 
+    # on the device of x
+    x = x.detach()
+    M, N = _fft_size(x, k)
+    A = fft.rfft2(x, (M, N)).abs()
+    A = _mirror(A, M, N)
+    return A.add_(tr.finfo(A.dtype).eps)
+
+def fft2np(x, k):
+    M, N = _fft_size(x, k)
+    A = np.abs(rfft2(x, (M, N), workers=-1))  #Multi-threaded
+    A = _mirror(A, M, N)
+    A += np.finfo(A.dtype).eps
+    return A
+
+def spectra(I, k):
+    '''
+    Amplitude spectra of a list of images. Images with the same shape (and
+    type, dtype and device) are stacked and transformed in a single call, by
+    fft2tor for tensors and fft2np for anything else. The list I itself is
+    not modified.
+    '''
+    I = [Im if torch.is_tensor(Im) else np.asarray(Im) for Im in I]
+    groups = {}
+    for i, Im in enumerate(I):
+        if torch.is_tensor(Im):
+            key = ('tensor', tuple(Im.shape), Im.dtype, Im.device)
+        else:
+            key = ('array', Im.shape, Im.dtype.str)
+        groups.setdefault(key, []).append(i)
+    
+    out = [None]*len(I)
+    for key, idx in groups.items():
+        if key[0] == 'tensor':
+            A = fft2tor(torch.stack([I[i].detach() for i in idx]), k)
+        else:
+            A = fft2np(np.stack([I[i] for i in idx]), k)
+        for j, i in enumerate(idx):
+            out[i] = A[j]
+    return out
+
+def decibal_(x):
+    # In place version of decibal (only for buffers owned by imshow2)
+    if torch.is_tensor(x):
+        return x.log10_().mul_(20)
+    np.log10(x, out=x)
+    x *= 20
+    return x
+
+def as_float(Im, dtype=np.float32):
+    '''
+    Converts the image to a floating point array ONCE, so that every later
+    stage of imshow2 can share the same buffer. No copy is made if the image
+    already has the requested dtype. Tensors are detached and kept on their
+    device.
+    '''
+    if torch.is_tensor(Im):
+        return Im.detach().to(torch.float64 if np.dtype(dtype) == np.float64 
+                              else torch.float32)
+    return np.asarray(Im, dtype=dtype)
+
+def first_sample(Im):
+    '''
+    Only the first sample of a 4D (N,C,H,W) input is ever drawn, so it is
+    sliced here, on the device of the input, before anything is converted or
+    moved to the host. Unless the image is RGB (C=3), only the first channel
+    is drawn, so the other channels are dropped as well. Other inputs are 
+    returned as is.
+    '''
+    if getattr(Im, 'ndim', 0) == 4:
+        Im = Im[0]
+        if Im.shape[0] != 3:
+            Im = Im[:1]
+    return Im
+
+def panel(Im):
+    '''Returns the 2D (nt,nx) panel of an image (first channel)'''
+    if Im.ndim == 4:
+        return Im[0,0]
+    if Im.ndim == 3:  #(C,H,W) after first_sample
+        return Im[0]
+    return Im
+
 def GC4imshow(Images):
     Images_GC = []
     for i in range(len(Images)):
@@ -112,6 +232,14 @@ def imshow2(I,
             fft_factor     = 3,
             dB             = None,
             transform      = None,
+            decimate       = None,
+            clip_method    = 'hist',
+            clip_tol       = None,
+            dtype          = np.float32,
+            fig            = None,
+            agc_dt         = 25/1000,
+            agc_gate       = 0.5,
+            agc_norm       = 1,
             **kwargs):
     '''
     Parameters
@@ -164,6 +292,43 @@ def imshow2(I,
     clip : TYPE = bool, optional
         Clips the minimum and maximum x% of the data (based on the frequency 
         histogram). The default is 0 (no clip:).
+    clip_method : TYPE = str, optional
+        How the clipped range is found when clip != 0. 'hist' finds both 
+        ends from a single histogram sweep, and 'exact' uses np.percentile
+        (see imstats.py). The default is 'hist'.
+    clip_tol : TYPE = float, optional
+        Allowed error of the 'hist' method as a fraction of the range of the
+        image (e.g. 1e-3). The default is None (no error).
+    dtype : TYPE = numpy dtype, optional
+        Every image is converted once to this dtype (np.float32 or 
+        np.float64), and the same buffer is used by all later stages.
+        The default is np.float32.
+    decimate : TYPE = str or bool, optional
+        Reduces each image to the number of pixels its axes can actually
+        show (computed from dpi, plotsize and grid) before it is drawn.
+        Use 'minmax' to keep the extreme value of each block (thin events
+        survive), or 'mean' for average pooling. True is the same as
+        'minmax'. RGB images always use 'mean'. The default is None (the 
+        full resolution image is handed to matplotlib).
+    fig : TYPE = matplotlib.figure.Figure, optional
+        Draws on this figure (resizing it) instead of creating a new one 
+        through pyplot. If the figure was drawn by imshow2 before with the
+        same layout, then only the data, range and titles of its images are
+        updated. The default is None (plt.figure is used).
+    AGC : TYPE = bool, optional
+        Applies automatic gain control to the images. If rang is an int, then
+        the gain map of I[rang] is applied to all images. Tensors are gain 
+        corrected on their own device (AGC.AGC) before being moved to the 
+        host, and arrays by AGC_np. The default is False.
+    agc_dt : TYPE = float, optional
+        Sampling interval of the images (in seconds) used by the AGC.
+        The default is 25/1000.
+    agc_gate : TYPE = float, optional
+        Length of the AGC gate (in seconds). The default is 0.5.
+    agc_norm : TYPE = int, optional
+        Normalization of the AGC. 0: none, 1: by the amplitude of each trace
+        (the range is then set to [-1,1]), 2: by the rms of each trace.
+        The default is 1.
     **kwargs : TYPE = who knows :)?
         Named arguments to be passed to plt.imshow. It can be passed either as
         individual named arguments or as a dictionary containing multiple
@@ -183,16 +348,20 @@ def imshow2(I,
     if type(I) != type([]):
         I = [I]  #Fixes the below for loops
     
+    # Only keep the sample that will be drawn (see first_sample). If the user
+    # has a transform, then it is given the full input and the slicing is done
+    # after it instead.
+    if transform is None:
+        I = [first_sample(Im) for Im in I]
+    
     if fft:
-        try:
-            I = [fft2tor(Im, fft_factor) for Im in I]
-        except:
-            I = [fft2np(Im, fft_factor) for Im in I]
+        I = spectra(I, fft_factor)
         if dB is None:
-            I = [decibal(Im) for Im in I]
+            I = [decibal_(Im) for Im in I]  #The spectra are new buffers
     
     if dB:
-        I = [decibal(Im) for Im in I]
+        # Never in place on the input (only on the spectra)
+        I = [decibal_(Im) if fft else decibal(Im) for Im in I]
         
     if transform is None:
         transform = [lambda x: x for i in range(len(I))]
@@ -200,15 +369,16 @@ def imshow2(I,
     elif type(transform) != type([]):
         transform = [transform for i in range(len(I))]
     
-    I = [transform[i](Im) for i, Im in enumerate(I)]
+    I = [first_sample(transform[i](Im)) for i, Im in enumerate(I)]
     
     # Edit: 2023-09-21 (not tested so it could cause further issues)
-    # Convert all images to numpy
-    for i, Im in enumerate(I):
-        try:
-            I[i] = np.array(Im, dtype=float) #To make sure the image is of type float
-        except:
-            I[i] = np.array(Im.cpu().detach().numpy(), dtype=float)
+    # Convert all images to float (only once, see as_float). Tensors are only 
+    # detached (and kept on their device) so that their statistics are 
+    # computed before any device to host transfer. They are moved to the CPU 
+    # just before being drawn.
+    # Note: the images are NOT copied if they already have the right dtype,
+    # so they should never be modified in place below.
+    I = [as_float(Im, dtype) for Im in I]
     
     if AGC is True and not AGC_import:
         print('WARNING! AGC WAS NOT IMPORTED!')
@@ -216,20 +386,31 @@ def imshow2(I,
         AGC = False
     
     if AGC is not False:
+        # Tensors are gain corrected on their own device (before any device 
+        # to host transfer), and arrays by AGC_np
+        def agc(Im):
+            func = AGC_tor if torch.is_tensor(Im) else AGC_np
+            with torch.no_grad():
+                return func(Im, agc_dt, agc_gate, agc_norm, return_gain_map=True)
+        nan_to_num = lambda x: torch.nan_to_num(x) if torch.is_tensor(x) else np.nan_to_num(x)
         if type(rang) == type(1):
-            Im = I[rang][0,0]
-            Im_AGC = AGC_np(Im, 25/1000, 0.5, 1)
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore") #suppress the warning about zero-division
-                gain_map = Im_AGC / Im
-            gain_map = np.nan_to_num(gain_map)
+            # The reference is usually the same image every call (e.g. the
+            # ground truth), so its gain map is cached
+            _, gain_map = agc_cache(panel(I[rang]), agc_dt, agc_gate, agc_norm)
+            gain_map = nan_to_num(gain_map)
             for i in range(len(I)):
-                I[i] *= gain_map
+                # The gain map has to follow the type (and device) of each image
+                if torch.is_tensor(I[i]):
+                    gain = torch.as_tensor(gain_map, device=I[i].device)
+                else:
+                    gain = gain_map.cpu().numpy() if torch.is_tensor(gain_map) else gain_map
+                I[i] = I[i] * gain  #Not in place (I[i] may be the input)
         else:
             for i in range(len(I)):
-                Im = I[i][0,0]
-                I[i] = np.nan_to_num(AGC_np(Im, 25/1000, 0.5, 1))
-        rang = [-1,1]
+                Im = panel(I[i])
+                I[i] = nan_to_num(agc(Im)[0])
+        if agc_norm == 1:
+            rang = [-1,1]
     
     if title is None:  #To avoid errors (didn't troubleshoot it yet)
         title = ['' for i in range(len(I))]
@@ -259,6 +440,11 @@ add a constant number there (or an image with zero standard deviation)\n'''
     elif len(I) == 1:
         grid = (1,1)  #if the user entered a single image, then use this grid
     
+    if decimate is True:
+        decimate = 'minmax'
+    if decimate:
+        budget = pixel_budget(dpi, plotsize, grid)
+    
     if t is None or offset is None:
         print(0)
         disable_Axes = True
@@ -325,89 +511,39 @@ corresponding image. Therefore, np.arange will be used to avoid errors.'''
             warnings.warn(error, UserWarning)
             offset[idx] = np.arange(I[idx].shape[-1])
 # =============================================================================
-# Create the image grid
+# Set the range
 # =============================================================================
-    # Create a figure which scales in size with respect to the grid size.
-    # This makes the text size to the "plot" size stay consistent.
-    fig = plt.figure(dpi=dpi, 
-                     figsize=(plotsize[0]*grid[1],plotsize[1]*grid[0]))
-                     # constrained_layout=True)
-    
-    # Below is a previous attempt at a custom image grid (consider it as a scrapyard)
-    # fig, ax = plt.subplots(grid[0], 
-    #                        grid[1], 
-    #                        plotsize=(plotsize[0]*grid[1],plotsize[1]*grid[0]), 
-    #                        dpi=200)
-                            # constrained_layout=True)
-    # The figure will have fixed width and its height will be adjusted
-    # according to the aspect ratio. Note that it is assumed that all images
-    # have the same aspect ratio
-    # plt.figure(dpi=300, plotsize=(5.5*grid[1],5.5*(H/W)*grid[0]))
-    # fig.subplots_adjust(left=None, bottom=None, right=None, top=None, wspace=0, hspace=0)
-    
-    # Create the image grid and include the colorbar if the user so desires
     if type(rang) == type('') and rang.lower() == 'norm':
         colorbar = False # Forcefully disable the colorbar if each plot has its
                          # its own range
-    if colorbar:
-        grid = ImageGrid(fig, 111,  # as in plt.subplot(111) (I don't understand this)
-                 nrows_ncols=(grid[0],grid[1]),
-                 axes_pad=pad,
-                 share_all=True,
-                 cbar_location="right",
-                 cbar_mode="single",
-                 cbar_size="7%",
-                 cbar_pad=pad,
-                 )
-    else:
-        grid = ImageGrid(fig, 111,
-                     nrows_ncols=(grid[0],grid[1]),
-                     share_all=True,
-                     axes_pad=pad)
-    
-    if figTransparent:
-        fig.patch.set_visible(False)
-        
-# =============================================================================
-# Set the range
-# =============================================================================
+
     
     # Preallocation
     n = len(I)
     minv = np.empty(n)
     maxv = np.empty(n)
+    stats = [None for i in range(n)]  #Reused by the ignoreZeroStd check below
     
     # I "guess" that the below for loop is a speed bottle neck, because when a
     # 4D tensor is used that has multiple samples, the function becomes very
     # slow. It is likely that converting all elements to a numpy array can
-    # take a lot of time to be completed. Another problem is that this specific
-    # for loop is found again in the next for loop, so this is not a bad
-    # oppotunity for optimization, even if its impact will rarely be seen
+    # take a lot of time to be completed. The statistics of each image are
+    # now computed only once here (see imstats.py).
     for i, Im in enumerate(I):
-        # Convert the image to a numpy array (in case it was a tensor)
+        # Find the minimum and maximum values of ALL images. If clip != 0, then
+        # the range is clipped instead (VERY useful for seismic images).
+        # Tensors are processed on their own device.
         try:
-            if torch.is_tensor(Im):
-                Im = Im.detach().float()
-                if Im.is_cuda:
-                    Im = Im.cpu()
-                Im = Im.numpy()
-            else:
-                Im = Im.astype('float')
+            stats[i] = imstats(Im, clip, clip_method, clip_tol)
         except:
             error = \
-f'''The image at index={i} CANNOT be converted to a numpy array.
+f'''The range of the image at index={i} CANNOT be computed.
 As such, it will be skipped'''
             warnings.warn(error, UserWarning)
             continue  #Skip to the next image
         
-        if clip != 0:
-            # The below clips the range (VERY useful for seismic images)
-            minv[i] = np.percentile(Im,     clip)  #To set the minimum value of the image
-            maxv[i] = np.percentile(Im, 100-clip)  #To set the maximum value of the image
-        else:
-            # Find the minimum and maximum values of ALL images
-            minv[i] = Im.min()  #To set the minimum value of the image
-            maxv[i] = Im.max()  #To set the maximum value of the image
+        minv[i] = stats[i].lo  #To set the minimum value of the image
+        maxv[i] = stats[i].hi  #To set the maximum value of the image
             
         if rangZeroCenter:
             # Ensuring the zero value is exactly at the center of the color map
@@ -444,29 +580,19 @@ As such, it will be skipped'''
             except:
                 # If rang was provided as an image, then extract its range and
                 # use it here (also, clip the range if clip>0)
-                # First, convert it to numpy
-                # Convert the image to a numpy array (in case it was a tensor)
-                try:  #Assume the image is on the CPU and has no gradients (tensor)
-                    rang = np.array(rang, dtype=float)  #To make sure the image is of type float
-                except:  #If this failed, then move the image to the cpu and detach the gradients
-                    rang = np.array(rang.cpu().detach(), dtype=float)  #To make sure the image is of type float
-                # Then, find the range based on the provided image
-                if clip != 0:
-                    # The below clips the range (VERY useful for seismic images)
-                    a = np.percentile(rang,     clip)  #To set the minimum value of the image
-                    b = np.percentile(rang, 100-clip)  #To set the maximum value of the image
-                    minv = a * np.ones(n)
-                    maxv = b * np.ones(n)
-                else:
-                    # Find the minimum and maximum values
-                    a = rang.min()  #To set the minimum value of the image
-                    b = rang.max()  #To set the maximum value of the image
-                    minv = a * np.ones(n)
-                    maxv = b * np.ones(n)
+                # First, convert it to numpy (tensors are kept on their device)
+                rang = as_float(rang, dtype)
+                # Then, find the range based on the provided image (the 
+                # range is clipped if clip != 0)
+                rang_stats = imstats(rang, clip, clip_method, clip_tol)
+                a = rang_stats.lo  #To set the minimum value of the image
+                b = rang_stats.hi  #To set the maximum value of the image
+                minv = a * np.ones(n)
+                maxv = b * np.ones(n)
                 if rangZeroCenter:
                     # Ensuring the zero value is exactly at the center of the 
                     # color map
-                    b = max(np.abs(maxv), np.abs(minv))
+                    b = max(np.abs(a), np.abs(b))
                     a = - b
                     minv = a * np.ones(n)
                     maxv = b * np.ones(n)
@@ -494,6 +620,79 @@ As such, the global minimum and maximum values will be used'''
                 b = maxv.max()
                 minv = a * np.ones(n)
                 maxv = b * np.ones(n)
+# =============================================================================
+# Create the image grid
+# =============================================================================
+    # Create a figure which scales in size with respect to the grid size.
+    # This makes the text size to the "plot" size stay consistent.
+    # If the figure was provided and it already shows the same layout (see 
+    # the persistent mode of lazy_imshow), then its images are only updated
+    # with set_data and set_clim, which is MUCH faster than rebuilding it.
+    skip = [bool(ignoreZeroStd and st is not None and st.constant) for st in stats]
+    layout = repr((tuple(grid), colorbar, pad, cbar_ticks, cbar_label, 
+                   fontsize, dpi, tuple(plotsize), figTransparent, n, skip,
+                   disable_Axes, alphabet, fft, kwargs))
+    # The layout and artists of a provided figure are kept as an attribute of
+    # the figure itself (they die with it). A global mapping would keep every
+    # figure alive, since its artists refer back to it
+    state = getattr(fig, '_imshow2_state', None) if fig is not None else None
+    keep_state = fig is not None
+    reuse = state is not None and state['layout'] == layout
+    if fig is None:
+        fig = plt.figure(dpi=dpi, 
+                         figsize=(plotsize[0]*grid[1],plotsize[1]*grid[0]))
+                         # constrained_layout=True)
+    elif not reuse:
+        # Draw on the provided figure instead (pyplot is never touched, see
+        # render.py)
+        fig.clear()
+        if fig.get_dpi() != dpi:
+            fig.set_dpi(dpi)
+        figsize = (plotsize[0]*grid[1],plotsize[1]*grid[0])
+        if tuple(fig.get_size_inches()) != figsize:
+            fig.set_size_inches(figsize)
+    
+    # Below is a previous attempt at a custom image grid (consider it as a scrapyard)
+    # fig, ax = plt.subplots(grid[0], 
+    #                        grid[1], 
+    #                        plotsize=(plotsize[0]*grid[1],plotsize[1]*grid[0]), 
+    #                        dpi=200)
+                            # constrained_layout=True)
+    # The figure will have fixed width and its height will be adjusted
+    # according to the aspect ratio. Note that it is assumed that all images
+    # have the same aspect ratio
+    # plt.figure(dpi=300, plotsize=(5.5*grid[1],5.5*(H/W)*grid[0]))
+    # fig.subplots_adjust(left=None, bottom=None, right=None, top=None, wspace=0, hspace=0)
+    
+    # Create the image grid and include the colorbar if the user so desires
+    if reuse:
+        grid = state['grid']
+    elif colorbar:
+        grid = ImageGrid(fig, 111,  # as in plt.subplot(111) (I don't understand this)
+                 nrows_ncols=(grid[0],grid[1]),
+                 axes_pad=pad,
+                 share_all=True,
+                 cbar_location="right",
+                 cbar_mode="single",
+                 cbar_size="7%",
+                 cbar_pad=pad,
+                 )
+    else:
+        grid = ImageGrid(fig, 111,
+                     nrows_ncols=(grid[0],grid[1]),
+                     share_all=True,
+                     axes_pad=pad)
+    
+    if figTransparent:
+        fig.patch.set_visible(False)
+    
+    if reuse:
+        images = state['images']
+    else:
+        images = [None for i in range(n)]  #The AxesImage of each image
+        if keep_state:
+            fig._imshow2_state = {'layout': layout, 'grid': grid, 'images': images}
+        
     idx = -1
     
     # The below if statement can be useful when using the figures for research 
@@ -518,21 +717,35 @@ As such, the global minimum and maximum values will be used'''
         # t = [np.linspace(-0.5, 0.5, len(tim)*fft_factor)/(tim[1]-tim[0]) for tim in t]
         # offset = [np.linspace(-0.5, 0.5, len(off)*fft_factor)/(off[1]-off[0]) for off in offset]
     
+    def draw(ax, idx, Im, **imshow_kwargs):
+        # Creates the image of the axes, or updates it if it already exists
+        show = images[idx]
+        if show is None:
+            show = images[idx] = ax.imshow(Im, **imshow_kwargs)
+        else:
+            show.set_data(Im)
+            show.set_clim(imshow_kwargs['vmin'], imshow_kwargs['vmax'])
+            show.set_extent(imshow_kwargs['extent'])
+            ax.set_aspect(imshow_kwargs['aspect'])
+            if 'cmap' in imshow_kwargs:
+                show.set_cmap(imshow_kwargs['cmap'])
+        return show
+    
     for ax in grid:
         idx += 1
-        # The below 
-        try:  #Assume the image is on the CPU and has no gradients
-            Im = np.array(I[idx], dtype=float)  #To make sure the image is of type float
+        # The images were already converted above (tensors are still on
+        # their device at this point)
+        try:
+            Im = I[idx]
         except:
-            try: #If the above failed, then move the image to the cpu and 
-                 #detach the gradients
-                Im = np.array(I[idx].cpu().detach(), dtype=float)  #To make sure the image is of type float
-            except:
+            if not reuse:
                 fig.delaxes(ax)
-                continue  #Skip to the next image
+            continue  #Skip to the next image
+        moveaxis = torch.movedim if torch.is_tensor(Im) else np.moveaxis
         # If the image was blank, then remove it from the figure
-        if Im.std() == 0.00 and ignoreZeroStd:
-            fig.delaxes(ax)
+        if skip[idx]:
+            if not reuse:
+                fig.delaxes(ax)
             continue  #Skip to the next image
         # plt.subplot(grid[0],grid[1], subplot[i])
         if alphabet:
@@ -573,12 +786,12 @@ As such, the global minimum and maximum values will be used'''
         #If the image has the channels in the first axis, then move it to the last
         if len(Im.shape) == 3 and min(Im.shape) == Im.shape[0]:
             # print('Moved the channels axis to align with plt.imshow')
-            Im = np.moveaxis(Im, 0, 2)
+            Im = moveaxis(Im, 0, 2)
         
         if len(Im.shape) == 4:  #If the image was a tensor (most likely)
                 # Use the first sample to convert it to a 3D array, and then
                 # move the channel axis to the last dimension
-                Im = np.moveaxis(Im[0],0,-1)  
+                Im = moveaxis(Im[0],0,-1)  
         
         # The below block is used for the extent
         t_min = t[idx].min().item()
@@ -591,9 +804,21 @@ As such, the global minimum and maximum values will be used'''
             # print(t)
             square_Axes = np.ptp(offset[idx]).item() / np.ptp(t[idx]).item()
         
+        # Reduce the image to the size of the axes (the extent above is kept,
+        # so the axes and aspect ratio are not affected)
+        if decimate and Im.ndim in (2,3):
+            if Im.ndim == 3 and Im.shape[-1] == 3:
+                Im = decimate_image(Im, budget, 'mean')  #Avoid mixing colors
+            else:
+                Im = decimate_image(Im, budget, decimate)
+        
+        # Only the (decimated) image that is actually drawn is moved to the host
+        if torch.is_tensor(Im):
+            Im = Im.cpu().numpy()
+        
         if len(Im.shape) == 2 or (len(Im.shape) == 3 and Im.shape[2] == 1): #If the image was grayscale,
             
-            show = ax.imshow(Im, cmap=cmap, vmin=minv[idx], vmax=maxv[idx], 
+            show = draw(ax, idx, Im, cmap=cmap, vmin=minv[idx], vmax=maxv[idx], 
                              aspect=aspect*square_Axes, 
                              extent=[offset_min, offset_max, t_max, t_min],
                              **kwargs)
@@ -606,7 +831,7 @@ As such, the global minimum and maximum values will be used'''
                 # print("The image does NOT have a standard range... \nNormalizing...")
         elif len(Im.shape) == 3:
             if Im.shape[-1] == 1: #If the image was grayscale,
-                show = ax.imshow(Im, cmap=cmap, vmin=minv[idx], vmax=maxv[idx], 
+                show = draw(ax, idx, Im, cmap=cmap, vmin=minv[idx], vmax=maxv[idx], 
                                  aspect=aspect*square_Axes, 
                                  extent=[offset_min, offset_max, t_max, t_min],
                                  **kwargs)
@@ -623,7 +848,7 @@ As such, the global minimum and maximum values will be used'''
                     div = 1
                 elif 0 <= Im.min() and Im.max() <= 255:
                     div = 255
-                show = ax.imshow(Im/div, vmin=minv[idx], vmax=maxv[idx], 
+                show = draw(ax, idx, Im/div, vmin=minv[idx], vmax=maxv[idx], 
                                  aspect=aspect*square_Axes, 
                                  extent=[offset_min, offset_max, t_max, t_min],
                                  **kwargs)
@@ -636,14 +861,14 @@ As such, the global minimum and maximum values will be used'''
                 #     plt.imshow(normIm(Im, 0, 255), vmin=0, vmax=255)
             else:
                 # Show only the first channel
-                show = ax.imshow(Im[:,:,0], cmap=cmap, vmin=minv[idx], vmax=maxv[idx], 
+                show = draw(ax, idx, Im[:,:,0], cmap=cmap, vmin=minv[idx], vmax=maxv[idx], 
                                  aspect=aspect*square_Axes, 
                                  extent=[offset_min, offset_max, t_max, t_min],
                                  **kwargs)
         else:
             print("Something isn't right with the dimensions of the image, so fix it!")
             #The above line is problematic
-    if colorbar:
+    if colorbar and not reuse:  #(the colorbar follows the updated image by itself)
         # from mpl_toolkits.axes_grid1 import make_axes_locatable, axes_size
         # aspect = 20
         # pad_fraction = 0.5
@@ -664,8 +889,14 @@ As such, the global minimum and maximum values will be used'''
         # plt.colorbar(sm)
         # cbar = ax.cax.colorbar(sm)
         
-        # Temporarily change the rcParam to solve deprecation warning
-        with mpl.rc_context({'mpl_toolkits.legacy_colorbar': False}):
+        # Temporarily change the rcParam to solve deprecation warning. Newer
+        # versions of matplotlib removed this rcParam (and changing the global
+        # rcParams is not thread-safe anyway), so it is only done if needed.
+        if 'mpl_toolkits.legacy_colorbar' in mpl.rcParams:
+            legacy = mpl.rc_context({'mpl_toolkits.legacy_colorbar': False})
+        else:
+            legacy = nullcontext()
+        with legacy:
             # consider cbar = fig.colorbar('something here')
             cbar = ax.cax.colorbar(show)
             cbar.ax.locator_params(nbins=cbar_ticks)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 21:40:13 2026
+
+imshow2 used to walk over each image several times: once for Im.min(), once
+for Im.max() (or two full np.percentile calls when clipping), and then once
+more for Im.std() just to find out whether the image is blank. The function
+below gathers everything imshow2 needs in a single call, so that both the
+range resolution and the ignoreZeroStd logic can share it.
+
+The clipped range can either be found by np.percentile ('exact', kept for
+reference) or by hist_percentile ('hist'), which finds both ends of the clip
+from a single fixed-bin histogram sweep instead of partitioning a full copy
+of the image. hist_percentile is exact unless an error bound (tol) is given.
+
+Tensors are handled on their own device (torch.quantile, or torch.kthvalue
+for tensors that are too large for torch.quantile), so only a few scalars
+are ever moved to the host.
+
+@author: ruwwad
+"""
+
+from collections import namedtuple
+import numpy as np
+import torch
+
+# minv, maxv: actual minimum and maximum values of the image
+# lo, hi:     clipped range (same as minv and maxv when clip=0)
+# constant:   True if the image has zero standard deviation
+ImStats = namedtuple('ImStats', ['minv', 'maxv', 'lo', 'hi', 'constant'])
+
+# Number of samples that are binned at a time (limits the size of temporaries)
+_CHUNK = 2**20
+# Largest input accepted by torch.quantile
+_QUANTILE_MAX = 2**24
+
+def _bin_index(x, minv, scale, bins):
+    idx = ((x - minv) * scale).astype(np.intp)
+    return np.minimum(idx, bins-1, out=idx)  #The maximum falls in the last bin
+
+def hist_percentile(Im, q, bins=4096, tol=None, minv=None, maxv=None):
+    '''
+    Histogram based percentiles. All requested percentiles are found from the
+    same sweep over the data (in chunks of _CHUNK samples). Images with an
+    infinite minimum or maximum cannot be binned, so np.percentile is used
+    for them instead.
+
+    Parameters
+    ----------
+    Im : TYPE = numpy array
+        The image.
+    q : TYPE = float or list of floats
+        Percentiles to compute (between 0 and 100).
+    bins : TYPE = int, optional
+        Number of histogram bins. The default is 4096.
+    tol : TYPE = float, optional
+        Error bound as a fraction of the range of the image (max - min). When
+        given, the values are interpolated inside the selected bins (using at
+        least 1/tol bins) and no refinement pass is performed. When None, the
+        selected bins are refined by a second sweep and the result matches 
+        np.percentile. The default is None.
+    minv, maxv : TYPE = float, optional
+        Minimum and maximum of the image, if they are already known.
+
+    Returns
+    -------
+    numpy array of the percentiles (same shape as q).
+    '''
+    x = np.asarray(Im).reshape(-1)
+    q = np.asarray(q, dtype=float)
+    n = x.size
+    if minv is None:
+        minv = x.min()
+    if maxv is None:
+        maxv = x.max()
+    if np.isnan(minv) or np.isnan(maxv):
+        return np.full(q.shape, np.nan)
+    if minv == maxv:
+        return np.full(q.shape, minv, dtype=float)
+    if not (np.isfinite(minv) and np.isfinite(maxv)):
+        # The bins cannot span an infinite range (e.g. dB of exact zeros)
+        return np.percentile(x, q)
+    if tol is not None:
+        bins = max(bins, int(np.ceil(1/tol)))
+    width = (float(maxv) - float(minv)) / bins
+    scale = 1 / width
+    
+    # First sweep: fixed-bin histogram
+    counts = np.zeros(bins, dtype=np.intp)
+    for start in range(0, n, _CHUNK):
+        idx = _bin_index(x[start:start+_CHUNK], minv, scale, bins)
+        counts += np.bincount(idx, minlength=bins)
+    cdf = np.cumsum(counts)
+    
+    # Ranks of the order statistics around each percentile (same virtual
+    # index as the default 'linear' method of np.percentile)
+    quantiles = q.reshape(-1)/100
+    virtual = n*quantiles + (1 - quantiles) - 1
+    k = np.floor(virtual).astype(np.intp)
+    frac = virtual - k
+    ranks = np.concatenate([k, np.minimum(k+1, n-1)])
+    rank_bins = np.searchsorted(cdf, ranks, side='right')
+    before = cdf[rank_bins] - counts[rank_bins]  #Samples below each bin
+    
+    if tol is not None:
+        # Assume the samples are spread uniformly inside their bin
+        pos = (ranks - before + 0.5) / counts[rank_bins]
+        values = float(minv) + (rank_bins + pos) * width
+    else:
+        # Second sweep: gather the samples of the selected bins only, and 
+        # find the exact order statistics among them
+        wanted = np.unique(rank_bins)
+        gathered = [[] for b in wanted]
+        for start in range(0, n, _CHUNK):
+            chunk = x[start:start+_CHUNK]
+            idx = _bin_index(chunk, minv, scale, bins)
+            for j, b in enumerate(wanted):
+                gathered[j].append(chunk[idx == b])
+        values = np.empty(ranks.shape)
+        for j, b in enumerate(wanted):
+            members = np.concatenate(gathered[j])
+            sel = rank_bins == b
+            kth = ranks[sel] - before[sel]
+            values[sel] = np.partition(members, np.unique(kth))[kth]
+    
+    # Linear interpolation between the two order statistics (np.percentile 
+    # style, which is more accurate for frac >= 0.5)
+    a, b = values[:k.size], values[k.size:]
+    diff = b - a
+    out = np.where(frac >= 0.5, b - diff*(1-frac), a + diff*frac)
+    return out.reshape(q.shape)
+
+def _torch_percentile(x, q):
+    # Same 'linear' interpolation as np.percentile, computed on the device
+    # of x. Returns a tensor of the percentiles (x must be flat and float)
+    quantiles = torch.tensor(q, dtype=x.dtype, device=x.device)/100
+    if x.numel() <= _QUANTILE_MAX:
+        return torch.quantile(x, quantiles)
+    n = x.numel()
+    values = []
+    for qq in q:
+        virtual = n*(qq/100) + (1 - qq/100) - 1
+        k = int(np.floor(virtual))
+        frac = virtual - k
+        a = x.kthvalue(k+1).values  #kthvalue is one-based
+        b = x.kthvalue(min(k+2, n)).values if frac > 0 else a
+        values.append(a + (b - a)*frac)
+    return torch.stack(values)
+
+def _imstats_torch(Im, clip=0):
+    x = Im.detach().reshape(-1)
+    if not x.is_floating_point():
+        x = x.float()
+    if clip != 0:
+        ends = _torch_percentile(x, [clip, 100-clip])
+        ends = torch.cat([x.min().reshape(1), ends, x.max().reshape(1)])
+    else:
+        ends = torch.stack([x.min(), x.max()])
+    # A single device to host transfer for all the statistics
+    ends = ends.tolist()
+    minv, maxv = ends[0], ends[-1]
+    lo, hi = (ends[1], ends[2]) if clip != 0 else (minv, maxv)
+    constant = bool(minv == maxv)
+    return ImStats(minv, maxv, lo, hi, constant)
+
+def imstats(Im, clip=0, method='hist', tol=None):
+    '''
+    Parameters
+    ----------
+    Im : TYPE = numpy array or tensor
+        The image. Tensors are processed on their own device.
+    clip : TYPE = float, optional
+        Percentage to be clipped from both ends of the histogram.
+        The default is 0 (no clip).
+    method : TYPE = str, optional
+        How the clipped range is found. Either 'hist' (see hist_percentile)
+        or 'exact' (np.percentile). Tensors are always exact. 
+        The default is 'hist'.
+    tol : TYPE = float, optional
+        Error bound of the 'hist' method (see hist_percentile). 
+        The default is None (exact).
+
+    Returns
+    -------
+    ImStats(minv, maxv, lo, hi, constant)
+    '''
+    if torch.is_tensor(Im):
+        return _imstats_torch(Im, clip)
+    Im = np.asarray(Im)
+    if clip != 0 and method == 'exact':
+        # All four order statistics are found by a single partition
+        minv, lo, hi, maxv = np.percentile(Im, [0, clip, 100-clip, 100])
+    else:
+        minv = Im.min()
+        maxv = Im.max()
+        if clip != 0:
+            lo, hi = hist_percentile(Im, [clip, 100-clip], tol=tol, 
+                                     minv=minv, maxv=maxv)
+        else:
+            lo, hi = minv, maxv
+    # An image has zero standard deviation if and only if min == max (NaN
+    # fails the comparison, just like NaN fails Im.std() == 0)
+    constant = bool(minv == maxv)
+    return ImStats(minv, maxv, lo, hi, constant)
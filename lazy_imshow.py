@@ -11,11 +11,18 @@ bar. Instead of having to change the arguments for each case, I can now define
 the arguments back and forth (which can still be temporarily overwritten even 
 after setting the new defaults).
 
+With persistent=True, the instance keeps its figure between calls. If the 
+layout did not change (e.g. showing the new predictions of every training 
+iteration), then only the data and range of the existing images are updated
+and the figure is redrawn, which is much faster than creating a new figure.
+
 @author: Someone lazy :)
 """
 
 from copy import deepcopy  #to copy the image regardless of whether its numpy or tensor
+import matplotlib.pyplot as plt
 from imshow2_offset import imshow2
+from render import render as render_to_buffer
 
 class lazy_imshow():
     def __init__(self, 
@@ -41,6 +48,7 @@ class lazy_imshow():
                  t              = None,
                  offset         = None,
                  fft            = False,
+                 persistent     = False,
                  **kwargs):
         #Store the defaults in self
         self.I              = I
@@ -65,6 +73,15 @@ class lazy_imshow():
         self.t              = t
         self.offset         = offset
         self.fft            = fft
+        self.persistent     = persistent
+        self.fig            = None  #Reused when persistent=True
+    
+    def __getstate__(self):
+        # The figure is not sent along with the defaults (e.g. to the workers
+        # of batch_render)
+        state = self.__dict__.copy()
+        state['fig'] = None
+        return state
         
     def imshow(self, 
              I              = None,
@@ -137,8 +154,14 @@ class lazy_imshow():
         if fft            == None:
             fft            = self.fft
         
+        if self.persistent and 'fig' not in kwargs:
+            # Keep drawing on the same figure (unless it was closed)
+            if self.fig is None or not plt.fignum_exists(self.fig.number):
+                self.fig = plt.figure()
+            kwargs['fig'] = self.fig
+        
         # Show the image
-        return \
+        out = \
         imshow2(I,
              title,
              grid,
@@ -163,11 +186,25 @@ class lazy_imshow():
              fft,
              **kwargs)
         
+        if self.persistent and kwargs['fig'] is self.fig:
+            self.fig.canvas.draw_idle()
+            self.fig.canvas.flush_events()
+        return out
+        
         # Note:
         # When calling imshowSeismic2, I could have used "named" arguments to
         # to avoid errors in the future (if I update the locations of 
         # imshowSeismic2's arguments, then errors will be raised). However, I
         # have intentionally did it this way to catch errors early on.
+    
+    def render(self, *args, format='png', **kwargs):
+        '''
+        Same as imshow, but the figure is returned as bytes (or an RGB numpy
+        array if format='rgb') without touching pyplot (see render.py).
+        '''
+        I = args[0] if args else kwargs.pop('I', None)
+        return render_to_buffer(I, *args[1:], format=format, imshow=self.imshow,
+                                **kwargs)
 
 # # =============================================================================
 # # Initialization Example (Outdated)
@@ -4,152 +4,381 @@
 Created on Sat Mar 19 17:30:03 2022
 
 This class patchifies the tensor into different patches, and provides an
-unpatchificiation function that is simple and quick to use.
+unpatchificiation function that is simple and quick to use. patch_inference
+runs a model over the patches of whole images one mini-batch at a time (so 
+the full patch tensor never has to fit in memory).
 
 Notes:
-    - The function is not perfect yet. Errors could rise if the image is not
-      neatly divided into patches.
+    - If the image is not neatly divided into patches, then its border is
+      dropped by patchify (and set to zero by unpatchify), unless the edge 
+      argument of patchify is used (padding or a final shifted patch).
     - Not sure if I have tested the use of non-square patches.
-    - The class loads the tensor to the CPU to avoid using the VRAM.
+    - patchify keeps the tensor on its device (the patches are a strided 
+      view of it, copied only once if a contiguous tensor is requested).
     - It works on 4D tensors
 
 @author: ruwwad
 """
 
-import numpy as np
+import warnings
 import torch
-from tqdm import tqdm
-
-from gaussian2d import gaussian2d
-from pyramid2d import pyramid2d
+import torch.nn.functional as F
+from functools import lru_cache
 
 pr = lambda a,b: print('{}.shape = {}'.format(a, b.shape))
+_pair = lambda x: tuple(x) if hasattr(x, '__len__') else (x, x)
+
+def _weight_1d(n, weight, std):
+    # Blending weights along one axis of a patch (all of them are positive,
+    # so every pixel of a patch counts)
+    i = torch.arange(n, dtype=torch.float64)
+    if weight == 'gaussian':
+        return torch.exp(-(i - (n-1)/2)**2 / (2*std**2))
+    elif weight == 'pyramid':
+        return torch.minimum(i+1, n-i)
+    return torch.ones(n, dtype=torch.float64)
+
+# Padding modes of the edge argument (and their names in F.pad)
+_PAD_MODES = {'zero': 'constant', 'reflect': 'reflect', 'replicate': 'replicate'}
+
+def _corners(n, size, stride, edge=None):
+    '''
+    Returns (corners, pad): the first pixel of every patch along an axis of n
+    pixels, and the number of pixels padded at the end of the axis.
+        - edge=None: the border that does not fit a whole patch is dropped.
+        - edge='zero', 'reflect' or 'replicate': the axis is padded so that
+          the patches cover it completely.
+        - edge='shift': a final patch is added (shifted back so that it ends
+          at the last pixel) if the others do not reach the end.
+    '''
+    pad = 0
+    if edge in _PAD_MODES:
+        pad = size - n if n <= size else -(n - size) % stride
+    elif edge not in [None, 'shift']:
+        raise ValueError(f"Unknown edge mode '{edge}'. Use None, 'shift', "
+                         "'zero', 'reflect' or 'replicate'.")
+    if edge == 'reflect' and pad >= n:
+        # F.pad can only reflect less than a full axis
+        raise ValueError(f"edge='reflect' cannot pad an axis of {n} pixels by {pad} "
+                         "(the image is narrower than a patch). Use 'replicate' "
+                         "or 'zero' instead.")
+    if n + pad < size:
+        raise ValueError(f'The patch size ({size}) is larger than the image ({n})')
+    corners = list(range(0, n + pad - size + 1, stride))
+    if edge == 'shift' and corners[-1] + size < n:
+        corners.append(n - size)
+    return corners, pad
+
+class PatchPlan():
+    '''
+    Everything unpatchify needs for a given geometry (image shape, patch 
+    size, stride, edge mode and weights): the corners of the patches, the
+    blending weights of a patch, and the inverse of the normalization map 
+    (the sum of the weights that land on each pixel). It is built once (see
+    patch_plan) and shared by all images with the same geometry. The
+    position of every pixel of the patches in the image is NOT kept (it is
+    n_patches*xMax*yMax int64 entries), see index instead.
+    
+    The weights are separable: the outer product of 1D weights along each
+    axis of the patch ('gaussian' with the given std, 'pyramid' for a tent 
+    that peaks at the center, or anything else for a plain average).
+    '''
+    def __init__(self, shape, patch_size, stride, weight='pyramid', std=22,
+                 device='cpu', dtype=torch.float32, edge=None):
+        H, W = shape
+        xMax, yMax = _pair(patch_size)
+        strideX, strideY = _pair(stride)
+        self.shape = (H, W)
+        self.xMax, self.yMax = xMax, yMax
+        self.stride = (strideX, strideY)
+        self.edge = edge
+        cornersX, padX = _corners(H, xMax, strideX, edge)
+        cornersY, padY = _corners(W, yMax, strideY, edge)
+        self.pad = (padX, padY)
+        self.padded_shape = (H + padX, W + padY)
+        self.cornersX, self.cornersY = cornersX, cornersY
+        self.patchX = len(cornersX)
+        self.patchY = len(cornersY)
+        self.n_patches = self.patchX*self.patchY
+        self.covered = (cornersX[-1] + xMax >= H and cornersY[-1] + yMax >= W)
+        
+        # Position (in the flattened padded image) of the corners, and of the
+        # pixels of a patch relative to its corner (see index)
+        Wp = self.padded_shape[1]
+        self._cornersX = torch.tensor(cornersX, device=device)*Wp
+        self._cornersY = torch.tensor(cornersY, device=device)
+        self._pixel = (torch.arange(xMax, device=device)[:,None]*Wp
+                       + torch.arange(yMax, device=device)[None]).reshape(-1)
+        
+        # None for a plain average (the patches do not have to be weighted)
+        self.weight = None
+        weightX = _weight_1d(xMax, weight, std)
+        weightY = _weight_1d(yMax, weight, std)
+        if (weightX != 1).any() or (weightY != 1).any():
+            self.weight = torch.outer(weightX, weightY).to(device=device, dtype=dtype)
+        
+        # Normalization map, and its inverse (zero where no patch lands). The
+        # patches sit on a grid and their weights are separable, so the map is
+        # the outer product of the sums along each axis
+        normX = torch.zeros(self.padded_shape[0], dtype=torch.float64)
+        normY = torch.zeros(self.padded_shape[1], dtype=torch.float64)
+        for c in cornersX:
+            normX[c:c+xMax] += weightX
+        for c in cornersY:
+            normY[c:c+yMax] += weightY
+        norm = torch.outer(normX, normY).to(device)
+        self.norm = norm.to(dtype)
+        self.inv_norm = torch.where(norm > 0, 1/norm, torch.zeros_like(norm)).to(dtype)
+    
+    def index(self, start=0, stop=None):
+        '''
+        Position (in the flattened padded image) of every pixel of the patches
+        number start, ..., stop-1, in the order of the patches (patchY*i+j) 
+        and then of their pixels. Built on demand, so only pass the patches
+        that are about to be added.
+        '''
+        stop = self.n_patches if stop is None else min(stop, self.n_patches)
+        k = torch.arange(start, stop, device=self._pixel.device)
+        corner = self._cornersX[k // self.patchY] + self._cornersY[k % self.patchY]
+        return (corner[:,None] + self._pixel).reshape(-1)
+
+@lru_cache(maxsize=32)
+def patch_plan(shape, patch_size, stride, weight='pyramid', std=22,
+               device='cpu', dtype=torch.float32, edge=None):
+    '''
+    Returns the (cached) PatchPlan of this geometry. All arguments must be
+    hashable (e.g. tuples instead of lists).
+    '''
+    return PatchPlan(shape, patch_size, stride, weight, std, device, dtype, edge)
+
 class Patch():
     def __init__(self, extraDim=0):
         self.Dim = extraDim  #Added dimensions
-    def patchify(self, I, patch_size, stride):
+    def patchify(self, I, patch_size, stride, contiguous=True, edge=None):
+        '''
+        Parameters
+        ----------
+        I : TYPE = 4D tensor with shape (N,C,H,W)
+            The images to be patchified (they stay on their device).
+        patch_size : TYPE = int or tuple (xMax, yMax)
+            Size of the patches.
+        stride : TYPE = int or tuple (strideX, strideY)
+            Step between two patches along each axis.
+        contiguous : TYPE = bool, optional
+            If True, the patches are copied into a new tensor with the shape
+            (N*n_patches, C, xMax, yMax), or (N, n_patches, C, xMax, yMax) if
+            extraDim != 0. If False, a strided view of I is returned instead
+            (no copy) with the shape (N, patchX, patchY, C, xMax, yMax), so it
+            should not be modified in place (with edge='shift' or a padding
+            mode, it is a view of a new tensor instead). The default is True.
+        edge : TYPE = str, optional
+            What to do with the border that does not fit a whole patch:
+            None drops it, 'zero', 'reflect' or 'replicate' pad the image (at
+            the bottom and right) so that the patches cover it, and 'shift'
+            adds a final patch along each axis that ends at the last pixel.
+            unpatchify crops the padding back. The default is None.
+
+        Returns
+        -------
+        The patches.
+        '''
         self.org_shape = I.shape
-        device = I.device
-        I = I.to('cpu')  #Could possibly save a little bit of VRAM this way
-        xMax, yMax = patch_size
-        N = I.shape[0]
-        patchX = int(np.ceil((I.shape[-2] - xMax + 1) / stride))
-        patchY = int(np.ceil((I.shape[-1] - yMax + 1) / stride))
-        # patchZ = int(np.ceil(I.shape[1] / strideChn))  #I am not sure about this
+        xMax, yMax = _pair(patch_size)
+        strideX, strideY = _pair(stride)
+        N, C = I.shape[0], I.shape[1]
+        cornersX, padX = _corners(I.shape[-2], xMax, strideX, edge)
+        cornersY, padY = _corners(I.shape[-1], yMax, strideY, edge)
+        patchX, patchY = len(cornersX), len(cornersY)
         n_patches = patchX*patchY
-        patches = torch.zeros((N, n_patches,I.shape[1],xMax,yMax))
         self.patchX = patchX
         self.patchY = patchY
-        # self.patchZ = patchZ
         self.xMax = xMax
         self.yMax = yMax
-        self.stride = stride
-        # print('patchX =', patchX)
-        # print('patchY =', patchY)
-        # print('patchZ =', patchZ)
-        # print('patch.shape =', patches.shape)
-        counter = 0
-        for n in range(N):
-            for i in range(patchX):
-                for j in range(patchY):
-                    # try:
-                        # print('n =', n)
-                        # print('k =', k)
-                        # print('Counter =',counter)
-                        # print('i =',i)
-                        # print('j =',j)
-                        # print('k =',k)
-                        # print('k*(patchX*patchY)+patchY*i+j=', k*(patchX*patchY)+patchY*i+j)
-                        # print('stride*i:stride*i+xMax =', np.arange(stride*i, stride*i+xMax+1))
-                        
-                        # print('I = \n{}'.format(I[k, 0, stride*i:stride*i+xMax
-                        #                             ,stride*j:stride*j+yMax]))
-                        # I[n,  0,  stride*i:stride*i+xMax  ,stride*j:stride*j+yMax]
-                        patches[n, patchY*i+j, :] \
-                            = I[n, :, stride*i:stride*i+xMax, stride*j:stride*j+yMax]
-                        counter += 1
-            # print(counter)
-        self.patches_shape = patches.shape  #Used to reshape 4D patches back to 5D
-        self.n_patches = patches.shape[1]
+        self.stride = (strideX, strideY)
+        self.edge = edge
+        self.patches_shape = (N, n_patches, C, xMax, yMax)  #Used to reshape 4D patches back to 5D
+        self.n_patches = n_patches
+        
+        if padX or padY:
+            I = F.pad(I, (0, padY, 0, padX), mode=_PAD_MODES[edge])
+        if edge == 'shift':
+            # The corners are not evenly spaced, so the patches are gathered
+            # (N,C,H,W) -> (N,C,patchX,xMax,W) -> (N,C,patchX,xMax,patchY,yMax)
+            rows = torch.tensor(cornersX, device=I.device)[:,None] + torch.arange(xMax, device=I.device)
+            cols = torch.tensor(cornersY, device=I.device)[:,None] + torch.arange(yMax, device=I.device)
+            patches = I[:, :, rows][..., cols].permute(0, 2, 4, 1, 3, 5)
+        else:
+            # (N,C,H,W) -> (N,C,patchX,patchY,xMax,yMax) -> (N,patchX,patchY,C,xMax,yMax)
+            patches = I.unfold(2, xMax, strideX).unfold(3, yMax, strideY)
+            patches = patches.permute(0, 2, 3, 1, 4, 5)
+        # Patch number patchY*i+j is the one at (cornersX[i], cornersY[j])
+        if not contiguous:
+            return patches
+        patches = patches.clone(memory_format=torch.contiguous_format)
         if self.Dim == 0: #Then merge the number of samples and patches
-            shap = [int(patches.shape[0] * patches.shape[1])]
-            for i in patches.shape[2:]:
-                shap.append(i)
-            # pr('patches', patches)
-            # print('mergedShape =', shap)
-            patches = patches.reshape(shap)
-        return patches.to(device)
+            return patches.reshape((N*n_patches, C, xMax, yMax))
+        return patches.reshape(self.patches_shape)
+    
+    def plan(self, weight='pyramid', std=22, device='cpu', dtype=torch.float32):
+        '''Returns the PatchPlan of the last patchified geometry'''
+        return patch_plan(tuple(self.org_shape[-2:]), (self.xMax, self.yMax),
+                          self.stride, weight, std, torch.device(device), dtype,
+                          self.edge)
+    
     def unpatchify(self, I, weight='pyramid', std=22):
-        device = I.device
-        I = I.to('cpu')
-        I = I.reshape(self.patches_shape)
-        N      = I.shape[0]
-        patchX = self.patchX
-        patchY = self.patchY
-        # patchZ = self.patchZ
-        xMax   = self.xMax
-        yMax   = self.yMax
-        stride = self.stride
-        out_shape = self.org_shape
-        # print('org.shape =', out_shape)
-        # n_patches = patchX*patchY
-        # pr('  I', I)
-        out  = torch.zeros((N, I.shape[2], out_shape[-2], out_shape[-1]))
-        self.norm = torch.clone(out)
-        if weight == 'gaussian':
-            weight = gaussian2d(I.shape, std)
-            weight = weight[:,0]+1
-        elif weight == 'pyramid':
-            weight = pyramid2d(I.shape)
-            weight = weight[:,0]+1
-        else:
-            weight = 0*torch.clone(I)
-            weight = weight[:,0]+1
-        # pr('out', out)
-        # print('patchX =', patchX)
-        # print('patchY =', patchY)
-        # print('patchZ =', patchZ)
-        # print('patch.shape =', patches.shape)
-        counter = 0
-        # print('patchX =', patchX)
-        # print('patchY =', patchY)
-        # for k in range(I.shape[1]):
-        for i in tqdm(range(patchX), desc='Unpatchifying'):
-            for j in range(patchY):
-                # print('I[:, counter] =', I[:, counter].shape)
-                # pr(' weight', weight)
-                out[:,:,stride*i:stride*i+xMax, stride*j:stride*j+yMax] \
-                    += I[:, counter] * weight
-                self.norm[:,:,stride*i:stride*i+xMax, stride*j:stride*j+yMax] \
-                    += weight
-                # print(f'out = \n{out}')
-                # print(f'self.norm = \n{self.norm}')
-                counter += 1
-        # print(f'self.norm = \n{self.norm}')
-        # pr('self.norm', self.norm)
-        # pr('weight', weight)
-        # self.norm = self.norm.sum(dim=1); print(f'self.norm = \n{self.norm}')
-        # return (out.sum(dim=1) / self.norm.sum(dim=1)).to(device)
-        out = out / self.norm  #This could perform 0/0, which will yield NaN
+        '''
+        Reassembles the patches (any shape returned by patchify) into images
+        with the original shape. Overlapping patches are blended by their 
+        weights. Everything runs on the device of I, and the patches are added
+        to the output by large chunks (index_add_, i.e. a scatter-add). The
+        weights and normalization map come from the cached PatchPlan, so they
+        are only built for the first image of each geometry.
+
+        Parameters
+        ----------
+        I : TYPE = tensor
+            The patches. They are blended in float32 (or float64 if they
+            already are), which is also the dtype of the output.
+        weight : TYPE = str, optional
+            'gaussian', 'pyramid', or anything else for a plain average.
+            The default is 'pyramid'.
+        std : TYPE = float, optional
+            Standard deviation of the gaussian weights. The default is 22.
+        '''
+        I = I.reshape(self.patches_shape[:2] + (-1,) + self.patches_shape[3:])  #The model may change C
+        N, n_patches, C = I.shape[:3]
+        H, W = self.org_shape[-2:]
+        # Accumulated in float32 at least (integer patches would truncate the
+        # weights, and float16 ones would overflow)
+        dtype = torch.promote_types(I.dtype, torch.float32)
+        plan = self.plan(weight, std, I.device, dtype)
+        Hp, Wp = plan.padded_shape
+        out = torch.zeros((N*C, Hp*Wp), dtype=dtype, device=I.device)
+        # The patches are added a chunk at a time, so the index of their 
+        # pixels stays small (at most 2**22 entries, i.e. 32 MB)
+        chunk = max(1, 2**22 // (self.xMax*self.yMax))
+        for start in range(0, n_patches, chunk):
+            cols = I[:, start:start+chunk].to(dtype)
+            if plan.weight is not None:
+                cols = cols * plan.weight
+            # (N,P,C,x,y) -> (N*C, P*x*y), the order of plan.index
+            cols = cols.transpose(1, 2).reshape(N*C, -1)
+            out.index_add_(1, plan.index(start, start+chunk), cols)
+        out = out.reshape(N, C, Hp, Wp).mul_(plan.inv_norm)
+        self.norm = plan.norm[:H, :W]
         
-        if torch.isnan(out).any():
-            print('''WARNING: The alogrithm produced NaN!
-                  
-This happened because the image does not neatly fit into patches.
-To fix this, change either the dimensions of the original image
-(by cropping or reshaping), or by choosing another patch dimensions
-that fit the image perfectly.
+        # The border that does not fit a whole patch is not covered by any
+        # patch. It is set to zero (inv_norm = 0 there) instead of 0/0 = NaN
+        if not plan.covered:
+            warnings.warn('''The image does not neatly fit into patches!
+The border that is not covered by any patch is set to zero.
+Use the edge argument of patchify to cover it.''', UserWarning)
+        if (Hp, Wp) != (H, W):
+            out = out[..., :H, :W].contiguous()  #Crop the padding
+        return out
 
-For now though, we will set the NaN to zero to avoid further complications.
 
-This problem "might" be addressed in a future update.''')
-        
-        # The algorithm could produce NaN due to division by zero (I guess).
-        # To circumvent this, each NaN will be set to zero.
-        # We use the property [NaN != NaN] to find the NaNs and set them to 0.
-        out[out != out] = torch.zeros(out[out != out].shape)
-        self.norm = self.norm[0,0] #To decrease the memory usage
-        return out.to(device)
+def iter_patches(I, plan, batch_size=64, device=None):
+    '''
+    Yields (n, start, batch): mini-batches of at most batch_size patches of
+    the sample I[n], where batch holds the patches number start, start+1, ...
+    (in the order of the plan) with the shape (B, C, xMax, yMax), on device.
+    Only one sample (padded if the plan requires it) and one mini-batch of
+    patches are ever copied at a time.
+    '''
+    device = I.device if device is None else torch.device(device)
+    padX, padY = plan.pad
+    cornersX = torch.tensor(plan.cornersX, device=I.device)
+    cornersY = torch.tensor(plan.cornersY, device=I.device)
+    rangeX = torch.arange(plan.xMax, device=I.device)
+    rangeY = torch.arange(plan.yMax, device=I.device)
+    for n in range(I.shape[0]):
+        Im = I[n]
+        if padX or padY:
+            Im = F.pad(Im[None], (0, padY, 0, padX), mode=_PAD_MODES[plan.edge])[0]
+        for start in range(0, plan.n_patches, batch_size):
+            k = torch.arange(start, min(start+batch_size, plan.n_patches), device=I.device)
+            rows = (cornersX[k // plan.patchY][:,None] + rangeX)[:, :, None]
+            cols = (cornersY[k %  plan.patchY][:,None] + rangeY)[:, None, :]
+            # (C, B, xMax, yMax) -> (B, C, xMax, yMax)
+            batch = Im[:, rows, cols].transpose(0, 1)
+            yield n, start, batch.to(device, non_blocking=True)
+
+def patch_inference(model, I, patch_size, stride, batch_size=64, 
+                    weight='pyramid', std=22, edge=None, device=None,
+                    autocast=False):
+    '''
+    Runs a model over all patches of the images I, one mini-batch of patches
+    at a time, and blends its outputs back into whole images (same as
+    Patch.patchify -> model -> Patch.unpatchify, but the full patch tensor 
+    never exists). The outputs are accumulated straight into the output
+    buffer of the current sample on the device of the model.
+
+    Parameters
+    ----------
+    model : TYPE = callable
+        Maps a batch of patches (B, C, xMax, yMax) to (B, C_out, xMax, yMax).
+    I : TYPE = 4D tensor with shape (N,C,H,W)
+        The images (e.g. a whole survey line, which may stay on the CPU).
+    patch_size, stride, edge :
+        Same as Patch.patchify.
+    batch_size : TYPE = int, optional
+        Number of patches per mini-batch. The default is 64.
+    weight, std :
+        Same as Patch.unpatchify.
+    device : TYPE = str or torch.device, optional
+        Where the model runs. The default is None (the device of I).
+    autocast : TYPE = bool or torch dtype, optional
+        Runs the model under torch.autocast (with the given dtype, or the 
+        default one of the device if True). The outputs are still 
+        accumulated in float32 (at least). The default is False.
+
+    Returns
+    -------
+    The output images with the shape (N, C_out, H, W), on the device of I.
+    '''
+    device = I.device if device is None else torch.device(device)
+    N = I.shape[0]
+    H, W = I.shape[-2:]
+    geometry = ((H, W), _pair(patch_size), _pair(stride), weight, std, device)
+    plan = patch_plan(*geometry, torch.float32, edge)
+    if not plan.covered:
+        warnings.warn('''The image does not neatly fit into patches!
+The border that is not covered by any patch is set to zero.
+Use the edge argument to cover it.''', UserWarning)
+    Hp, Wp = plan.padded_shape
+    amp = torch.autocast(device.type, 
+                         dtype=autocast if isinstance(autocast, torch.dtype) else None,
+                         enabled=bool(autocast))
+    
+    out = None
+    acc = None
+    for n, start, batch in iter_patches(I, plan, batch_size, device):
+        with torch.no_grad(), amp:
+            pred = model(batch)
+        if tuple(pred.shape[-2:]) != (plan.xMax, plan.yMax):
+            raise ValueError(f'The model returned patches of size {tuple(pred.shape[-2:])} '
+                             f'instead of {(plan.xMax, plan.yMax)}')
+        if acc is None:
+            dtype = torch.promote_types(pred.dtype, torch.float32)
+            acc = torch.zeros((pred.shape[1], Hp*Wp), dtype=dtype, device=device)
+            out = torch.empty((N, pred.shape[1], H, W), dtype=dtype, device=I.device)
+            # Weights and inv_norm in the dtype of the accumulator (same 
+            # corners, so iter_patches can keep the float32 plan)
+            plan = patch_plan(*geometry, dtype, edge)
+        pred = pred.to(acc.dtype)
+        if plan.weight is not None:
+            pred = pred * plan.weight
+        # (B, C_out, x, y) -> (C_out, B*x*y), the order of plan.index
+        B = pred.shape[0]
+        acc.index_add_(1, plan.index(start, start+B), 
+                       pred.transpose(0, 1).reshape(pred.shape[1], -1))
+        if start + B == plan.n_patches:
+            # Last mini-batch of the sample: normalize, crop and move it out
+            Im = acc.reshape(-1, Hp, Wp).mul_(plan.inv_norm)[:, :H, :W]
+            out[n] = Im.to(I.device)
+            acc.zero_()
+    return out
 
 
 # =============================================================================
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 10:17:25 2026
+
+imshow2 normally creates its figure through plt.figure, which relies on the
+global pyplot state machine. That state is not thread-safe, and figures leak
+if they are not closed when imshow2 is called in a loop. The function below
+draws on a standalone matplotlib.figure.Figure with an Agg canvas instead, and
+returns the result as PNG bytes (or any other format supported by savefig) or
+as an RGB numpy array. Pyplot is never touched, so it can be called from many
+threads at once (e.g. through concurrent.futures.ThreadPoolExecutor).
+
+Example:
+    png = render(Images, titles, grid=(2,2), clip=1)
+    rgb = render(Images, titles, grid=(2,2), clip=1, format='rgb')
+
+@author: ruwwad
+"""
+
+from io import BytesIO
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from imshow2_offset import imshow2
+
+def figure_to_buffer(fig, format='png'):
+    '''
+    Returns the figure as an RGB numpy array with shape (H,W,3) and dtype 
+    uint8 if format='rgb', or as the bytes of a file of the given format 
+    otherwise. The figure must have a canvas (e.g. FigureCanvasAgg).
+    '''
+    if format == 'rgb':
+        fig.canvas.draw()
+        return np.asarray(fig.canvas.buffer_rgba())[:,:,:3].copy()
+    buffer = BytesIO()
+    fig.savefig(buffer, format=format, dpi=fig.dpi)
+    return buffer.getvalue()
+
+def render(I, *args, format='png', imshow=imshow2, **kwargs):
+    '''
+    Parameters
+    ----------
+    I, *args, **kwargs :
+        Same arguments as imshow2.
+    format : TYPE = str, optional
+        'rgb' returns the figure as a numpy array with shape (H,W,3) and 
+        dtype uint8. Anything else is passed to savefig as the file format 
+        (e.g. 'png', 'jpg', 'pdf') and the file is returned as bytes.
+        The default is 'png'.
+    imshow : TYPE = function, optional
+        The function that draws the images. It must accept the fig argument
+        of imshow2 (e.g. lazy_imshow(...).imshow). The default is imshow2.
+
+    Returns
+    -------
+    bytes or numpy array.
+    '''
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    imshow(I, *args, fig=fig, **kwargs)
+    return figure_to_buffer(fig, format)